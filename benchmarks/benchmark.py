@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reproducible benchmarks for hdu.
+
+Generates a synthetic directory tree of configurable shape in a temporary
+directory and times separately `walk2()`, `disk_usage()`,
+`disk_usage_to_str()` and the end-to-end `hdu` command-line interface,
+reporting the scanning rate and the peak memory usage.
+Results can be saved as JSON and compared with previous results.
+"""
+
+# ======================================================================
+# :: Future Imports (for Python 2)
+from __future__ import (
+    division, absolute_import, print_function, unicode_literals)
+
+# ======================================================================
+# :: Python Standard Library Imports
+import os  # Miscellaneous operating system interfaces
+import sys  # System-specific parameters and functions
+import argparse  # Parser for command-line options, arguments and subcommands
+import json  # JSON encoder and decoder
+import platform  # Access to underlying platform's identifying data
+import random  # Generate pseudo-random numbers
+import resource  # Resource usage information
+import shutil  # High-level file operations
+import subprocess  # Subprocess management
+import tempfile  # Generate temporary files and directories
+import time  # Time access and conversions
+import tracemalloc  # Trace memory allocations
+
+# ======================================================================
+# :: hdu Imports
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from hdu import hdu  # noqa: E402
+
+# ======================================================================
+# :: default shape of the synthetic tree
+D_SHAPE = dict(
+    fan_out=4,
+    depth=5,
+    num_files=20,
+    max_file_size=4096,
+    hidden_ratio=0.05,
+    link_ratio=0.02,
+    hard_link_ratio=0.02,
+    seed=0)
+
+
+# ======================================================================
+def make_tree(
+        base,
+        fan_out=D_SHAPE['fan_out'],
+        depth=D_SHAPE['depth'],
+        num_files=D_SHAPE['num_files'],
+        max_file_size=D_SHAPE['max_file_size'],
+        hidden_ratio=D_SHAPE['hidden_ratio'],
+        link_ratio=D_SHAPE['link_ratio'],
+        hard_link_ratio=D_SHAPE['hard_link_ratio'],
+        seed=D_SHAPE['seed']):
+    """
+    Generate a synthetic directory tree.
+
+    Args:
+        base (str): directory where to generate the tree
+        fan_out (int): number of sub-directories of each directory
+        depth (int): number of levels of sub-directories
+        num_files (int): number of files in each directory
+        max_file_size (int): max size of each file in bytes
+        hidden_ratio (float): fraction of hidden files and directories
+        link_ratio (float): fraction of files that are symbolic links
+        hard_link_ratio (float): fraction of files that are hard links
+        seed (int): seed for the pseudo-random number generator
+
+    Returns:
+        num_entries (int): the number of generated entries
+    """
+    rng = random.Random(seed)
+    num_entries = 0
+    last_file = None
+    dirs = [(base, 0)]
+    while dirs:
+        path, level = dirs.pop()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for i in range(num_files):
+            prefix = '.' if rng.random() < hidden_ratio else ''
+            filepath = os.path.join(path, '{}file{}'.format(prefix, i))
+            choice = rng.random()
+            if last_file and choice < link_ratio:
+                os.symlink(last_file, filepath)
+            elif last_file and choice < link_ratio + hard_link_ratio:
+                os.link(last_file, filepath)
+            else:
+                with open(filepath, 'wb') as file_obj:
+                    file_obj.truncate(rng.randint(0, max_file_size))
+                last_file = filepath
+            num_entries += 1
+        if level < depth:
+            for i in range(fan_out):
+                prefix = '.' if rng.random() < hidden_ratio else ''
+                dirs.append(
+                    (os.path.join(path, '{}dir{}'.format(prefix, i)),
+                     level + 1))
+                num_entries += 1
+    return num_entries
+
+
+# ======================================================================
+def _measure(func, num_repeats):
+    """
+    Measure the best wall time and the peak memory of a function.
+
+    Args:
+        func (callable): the function to measure
+        num_repeats (int): number of repetitions
+
+    Returns:
+        result (dict): the measurements:
+            - 'time': best wall time in seconds
+            - 'peak_memory': peak memory allocated (as traced) in bytes
+            - 'value': the value returned by the last call
+    """
+    best_time = float('inf')
+    value = None
+    for _ in range(num_repeats):
+        begin_time = time.perf_counter()
+        value = func()
+        best_time = min(best_time, time.perf_counter() - begin_time)
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dict(time=best_time, peak_memory=peak_memory, value=value)
+
+
+# ======================================================================
+def run(
+        base,
+        num_entries,
+        num_repeats=3,
+        max_depth=1,
+        workers=1):
+    """
+    Run the benchmarks on a directory.
+
+    Args:
+        base (str): directory where to operate
+        num_entries (int): number of entries in the directory
+        num_repeats (int): number of repetitions (the best is kept)
+        max_depth (int): max depth of the displayed items
+        workers (int): number of threads used for scanning directories
+
+    Returns:
+        results (dict): the results of each benchmark
+    """
+    results = {}
+    opts = dict(
+        follow_links=False, follow_mounts=False, allow_special=False,
+        allow_hidden=True)
+
+    measured = _measure(
+        lambda: sum(1 for _ in hdu.walk2(base, workers=workers, **opts)),
+        num_repeats)
+    results['walk2'] = measured
+
+    measured = _measure(
+        lambda: hdu.disk_usage(
+            base, max_depth=max_depth, workers=workers, **opts),
+        num_repeats)
+    results['disk_usage'] = measured
+
+    contents, total_size, num_files, num_dirs = measured['value']
+    contents = dict(contents.items())
+    measured = _measure(
+        lambda: hdu.disk_usage_to_str(
+            contents, total_size, num_files, num_dirs, base),
+        num_repeats)
+    results['disk_usage_to_str'] = measured
+
+    cmd = [
+        sys.executable, '-m', 'hdu.hdu', base, '-i',
+        '--max_depth={}'.format(max_depth), '--jobs={}'.format(workers)]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(hdu.__file__))]
+        + env.get('PYTHONPATH', '').split(os.pathsep))
+    best_time = float('inf')
+    for _ in range(num_repeats):
+        begin_time = time.perf_counter()
+        subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL)
+        best_time = min(best_time, time.perf_counter() - begin_time)
+    # ru_maxrss is in kilobytes on Linux
+    peak_memory = \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    results['cli'] = dict(time=best_time, peak_memory=peak_memory)
+
+    for name, measured in results.items():
+        measured.pop('value', None)
+        measured['entries_per_sec'] = \
+            num_entries / measured['time'] if measured['time'] else 0.0
+    return results
+
+
+# ======================================================================
+def compare(results, old_results):
+    """
+    Compare the results with previous results.
+
+    Args:
+        results (dict): the results (as saved by `main()`)
+        old_results (dict): the previous results (as saved by `main()`)
+
+    Returns:
+        text (str): the comparison, one benchmark per line
+    """
+    lines = []
+    for name, measured in results['benchmarks'].items():
+        old_measured = old_results['benchmarks'].get(name)
+        if old_measured:
+            lines.append(
+                '{:<20} time: {:6.2f}x  peak memory: {:6.2f}x'.format(
+                    name,
+                    measured['time'] / old_measured['time'],
+                    measured['peak_memory'] / old_measured['peak_memory']
+                    if old_measured['peak_memory'] else 0.0))
+    return '\n'.join(lines)
+
+
+# ======================================================================
+def handle_arg():
+    """
+    Handle command-line application arguments.
+    """
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name, value in sorted(D_SHAPE.items()):
+        arg_parser.add_argument(
+            '--' + name, metavar='X',
+            type=type(value), default=value,
+            help='{} of the synthetic tree [%(default)s]'.format(
+                name.replace('_', ' ')))
+    arg_parser.add_argument(
+        '-r', '--repeats', metavar='N',
+        type=int, default=3,
+        help='number of repetitions (the best is kept) [%(default)s]')
+    arg_parser.add_argument(
+        '-d', '--max_depth', metavar='N',
+        type=int, default=1,
+        help='max depth of the displayed items [%(default)s]')
+    arg_parser.add_argument(
+        '-j', '--jobs', metavar='N',
+        type=int, default=1,
+        help='number of threads for scanning directories [%(default)s]')
+    arg_parser.add_argument(
+        '-o', '--output', metavar='FILE',
+        default=None,
+        help='save the results as JSON [%(default)s]')
+    arg_parser.add_argument(
+        '-c', '--compare', metavar='FILE',
+        default=None,
+        help='compare with previously saved results [%(default)s]')
+    arg_parser.add_argument(
+        '-k', '--keep', metavar='DIR',
+        default=None,
+        help='generate the tree in DIR and keep it (reused if it exists) '
+             '[%(default)s]')
+    return arg_parser
+
+
+# ======================================================================
+def main():
+    """The main routine."""
+    arg_parser = handle_arg()
+    args = arg_parser.parse_args()
+    shape = {name: getattr(args, name) for name in D_SHAPE}
+
+    base = args.keep if args.keep else tempfile.mkdtemp(prefix='hdu_bench_')
+    try:
+        begin_time = time.perf_counter()
+        if args.keep and os.path.isdir(base):
+            num_entries = sum(1 for _ in hdu.walk2(base))
+        else:
+            num_entries = make_tree(base, **shape)
+        print('I: {} entries in: {} ({:.2f}s)'.format(
+            num_entries, base, time.perf_counter() - begin_time))
+        benchmarks = run(
+            base, num_entries, args.repeats, args.max_depth, args.jobs)
+    finally:
+        if not args.keep:
+            shutil.rmtree(base)
+
+    results = dict(
+        version=hdu.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        shape=shape,
+        num_entries=num_entries,
+        max_depth=args.max_depth,
+        jobs=args.jobs,
+        benchmarks=benchmarks)
+    for name, measured in benchmarks.items():
+        print('{:<20} {:9.4f}s {:12.0f} entries/s {:10.1f} MiB'.format(
+            name, measured['time'], measured['entries_per_sec'],
+            measured['peak_memory'] / 2 ** 20))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as old_file:
+            print(compare(results, json.load(old_file)))
+
+
+# ======================================================================
+if __name__ == '__main__':
+    main()
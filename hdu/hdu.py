@@ -16,12 +16,49 @@ from __future__ import (
 # ======================================================================
 # :: Python Standard Library Imports
 import os  # Miscellaneous operating system interfaces
-# import sys  # System-specific parameters and functions
+import sys  # System-specific parameters and functions
 import math  # Mathematical functions
 import argparse  # Parser for command-line options, arguments and subcommands
 import re  # Regular expression operations
 import warnings  # Warning control
 import stat  # Interpreting stat() results
+import collections  # Container datatypes
+import collections.abc  # Abstract Base Classes for Containers
+import queue  # A synchronized queue class
+import concurrent.futures  # Launching parallel tasks
+import sqlite3  # DB-API 2.0 interface for SQLite databases
+import time  # Time access and conversions
+import array  # Efficient arrays of numeric values
+import heapq  # Heap queue algorithm
+import io  # Core tools for working with streams
+import json  # JSON encoder and decoder
+import gzip  # Support for gzip files
+import bz2  # Support for bzip2 compression
+import lzma  # Compression using the LZMA algorithm
+import threading  # Thread-based parallelism
+import functools  # Higher-order functions and operations on callable objects
+import bisect  # Array bisection algorithm
+import random  # Generate pseudo-random numbers
+import statistics  # Mathematical statistics functions
+import asyncio  # Asynchronous I/O
+import ctypes  # A foreign function library for Python
+import ctypes.util  # Utility functions for ctypes
+import errno  # Standard errno system symbols
+import select  # Waiting for I/O completion
+import struct  # Interpret bytes as packed binary data
+import fnmatch  # Unix filename pattern matching
+import zlib  # Compression compatible with gzip
+
+try:
+    import curses  # Terminal handling for character-cell displays
+except ImportError:
+    curses = None
+
+try:
+    import pwd  # The password database
+    import grp  # The group database
+except ImportError:
+    pwd = grp = None
 
 # ======================================================================
 # :: Version
@@ -58,13 +95,58 @@ UNITS_PREFIX = ('k', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
 # by the definition of units, the length of the size str cannot exceed 4
 MAX_CHAR_SIZE = 4
 
+# number of orders of magnitude, including bytes
+NUM_ORDERS = len(UNITS_PREFIX) + 1
 
-# ======================================================================
-def _is_hidden(filepath):
-    # if sys.version_info[0] > 2:
-    #     filepath = filepath.encode('utf-8')
-    # filepath = filepath.decode('utf-8')
-    return os.path.basename(filepath).startswith('.')
+# the upper bound in seconds and the name of the age buckets
+AGE_BUCKETS = (
+    (24 * 3600, '1 day'), (7 * 24 * 3600, '1 week'),
+    (30 * 24 * 3600, '1 month'), (91 * 24 * 3600, '3 months'),
+    (365 * 24 * 3600, '1 year'), (3 * 365 * 24 * 3600, '3 years'))
+
+# the format of the size str (and the smallest value using it),
+# depending on the number of digits of the integral part
+_SIZE_FORMATS = tuple(
+    '{{:3.{}f}}'.format(max(MAX_CHAR_SIZE - n - 1, 0)).format
+    for n in range(1, MAX_CHAR_SIZE + 1))
+_SIZE_THRESHOLDS = tuple(10 ** n for n in range(1, MAX_CHAR_SIZE))
+
+# explicit units, e.g. kB (SI), KiB (IEC) or K (UNIX)
+_EXPLICIT_UNITS_RE = re.compile(
+    '[{0}]B|[{1}](iB)?'.format(
+        ''.join(UNITS_PREFIX), ''.join(UNITS_PREFIX).upper()))
+
+# the stats of each entry in a snapshot (after the relative path)
+SNAPSHOT_FIELDS = (
+    'st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid', 'st_size',
+    'st_atime', 'st_mtime', 'st_ctime', 'st_blocks')
+
+# the inotify events relevant to the disk usage of a directory:
+# IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# | IN_ONLYDIR | IN_DONT_FOLLOW
+INOTIFY_MASK = 0x002 | 0x004 | 0x040 | 0x080 | 0x100 | 0x200 \
+    | 0x01000000 | 0x02000000
+INOTIFY_Q_OVERFLOW = 0x4000
+INOTIFY_IGNORED = 0x8000
+# struct inotify_event (without the name)
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+# the multiplier for Fibonacci hashing (2^64 / golden ratio)
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+# the number of the ioprio_set system call on Linux, depending on the machine
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+    'ppc64le': 273, 'ppc64': 273, 's390x': 282, 'riscv64': 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# default location of the scan cache
+D_CACHE_FILEPATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'hdu', 'cache.sqlite')
 
 
 # ======================================================================
@@ -76,13 +158,568 @@ def _is_special(stats_mode):
 
 
 # ======================================================================
-def _or_not_and(flag, check):
-    return flag or not flag and check
+class ScanStats(object):
+    """
+    Collector of timings and counters of a scan.
+
+    Records the wall and CPU time of the phases (e.g. 'disk_usage' and
+    'render'), the time spent listing and stat'ing each directory, the
+    number of directory listings, `stat` calls and (swallowed) errors, and
+    the slowest directories.
+    Counters are updated once per directory (not per entry) and are
+    thread-safe.
+
+    Attributes:
+        num_slowest (int): number of slowest directories to keep
+        wall_times (dict): the wall time of each phase in seconds
+        cpu_times (dict): the CPU time (of the process) of each phase in
+            seconds
+        scan_time (float): the time spent listing and stat'ing in seconds
+            (summed over all threads)
+        num_listdir (int): number of directory listings
+        num_stat (int): number of `stat` calls
+        num_errors (int): number of errors
+        num_entries (int): number of allowed entries found
+        slowest (list[tuple]): the (time, path) of the slowest directories
+    """
+
+    def __init__(self, num_slowest=10):
+        self.num_slowest = num_slowest
+        self.wall_times = collections.OrderedDict()
+        self.cpu_times = collections.OrderedDict()
+        self.scan_time = 0.0
+        self.num_listdir = 0
+        self.num_stat = 0
+        self.num_errors = 0
+        self.num_entries = 0
+        self.slowest = []
+        self._begin_times = {}
+        self._lock = threading.Lock()
+
+    def begin(self, phase):
+        """
+        Mark the beginning of a phase.
+
+        Args:
+            phase (str): the name of the phase
+
+        Returns:
+            None
+        """
+        self._begin_times[phase] = time.perf_counter(), time.process_time()
+
+    def end(self, phase):
+        """
+        Mark the end of a phase.
+
+        Args:
+            phase (str): the name of the phase
+
+        Returns:
+            None
+        """
+        wall_time, cpu_time = self._begin_times.pop(phase)
+        self.wall_times[phase] = self.wall_times.get(phase, 0.0) \
+            + time.perf_counter() - wall_time
+        self.cpu_times[phase] = self.cpu_times.get(phase, 0.0) \
+            + time.process_time() - cpu_time
+
+    def add_dir(
+            self,
+            path,
+            elapsed,
+            num_stat,
+            num_errors,
+            num_entries,
+            listed=True):
+        """
+        Account for a scanned directory.
+
+        Args:
+            path (str): the path of the directory
+            elapsed (float): the time spent in seconds
+            num_stat (int): the number of `stat` calls
+            num_errors (int): the number of errors
+            num_entries (int): the number of allowed entries
+            listed (bool): True if the directory was listed
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.scan_time += elapsed
+            self.num_listdir += listed
+            self.num_stat += num_stat
+            self.num_errors += num_errors
+            self.num_entries += num_entries
+            if len(self.slowest) < self.num_slowest:
+                heapq.heappush(self.slowest, (elapsed, path))
+            elif elapsed > self.slowest[0][0]:
+                heapq.heappushpop(self.slowest, (elapsed, path))
+
+    def to_str(self, line_sep='\n'):
+        """
+        Convert the statistics to human-readable text.
+
+        Args:
+            line_sep (str): line separator
+
+        Returns:
+            text (str): String containing the statistics
+        """
+        lines = ['I: phases: ' + ', '.join(
+            '{}: {:.3f}s (CPU: {:.3f}s)'.format(
+                phase, wall_time, self.cpu_times[phase])
+            for phase, wall_time in self.wall_times.items())]
+        total_time = self.wall_times.get('disk_usage', 0.0)
+        lines.append(
+            'I: listing and stat: {:.3f}s (summed over threads)'.format(
+                self.scan_time))
+        lines.append(
+            'I: listdir: {}, stat: {}, errors: {}, entries: {} ({:.0f}/s)'
+            .format(
+                self.num_listdir, self.num_stat, self.num_errors,
+                self.num_entries,
+                self.num_entries / total_time if total_time else 0.0))
+        if self.slowest:
+            lines.append('I: slowest directories:')
+            lines.extend(
+                'I: {:10.6f}s {}'.format(elapsed, path)
+                for elapsed, path in sorted(self.slowest, reverse=True))
+        return line_sep.join(lines)
+
+
+# ======================================================================
+class NameFilter(object):
+    """
+    Filter of the entries by name, compiled into a single matcher.
+
+    Excluded entries are skipped before they are stat'ed, therefore
+    excluded directories are not descended into, at the cost of a single
+    match of their name.
+    If include patterns are specified, only the files matching any of them
+    are kept; directories are always descended into (unless excluded).
+    Glob patterns (see `fnmatch`) must match the whole name, while regular
+    expressions may match anywhere in the name.
+
+    Attributes:
+        exclude (callable|None): returns a match if a name is excluded
+        include (callable|None): returns a match if a file name is included
+        signature (int): checksum of the patterns (e.g. for caching)
+        num_pruned (int): number of entries skipped so far
+    """
+
+    def __init__(
+            self,
+            exclude=(),
+            include=(),
+            exclude_regex=(),
+            include_regex=()):
+        """
+        Args:
+            exclude (Iterable[str]): glob patterns of the names to exclude
+            include (Iterable[str]): glob patterns of the file names to
+                include
+            exclude_regex (Iterable[str]): regular expressions of the names
+                to exclude
+            include_regex (Iterable[str]): regular expressions of the file
+                names to include
+        """
+        patterns = [list(exclude), list(include), list(exclude_regex),
+                    list(include_regex)]
+        self.exclude = self._compile(patterns[0], patterns[2])
+        self.include = self._compile(patterns[1], patterns[3])
+        self.signature = zlib.crc32(json.dumps(patterns).encode('utf-8'))
+        self.num_pruned = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _compile(globs, regexes):
+        # the regexes are compiled separately, so that their inline flags
+        # and group references are not affected by the other patterns
+        matchers = [re.compile(regex).search for regex in regexes]
+        if globs:
+            matchers.insert(0, re.compile('|'.join(
+                fnmatch.translate(glob) for glob in globs)).match)
+        if len(matchers) > 1:
+            return lambda name: any(match(name) for match in matchers)
+        else:
+            return matchers[0] if matchers else None
+
+    def add_pruned(self, num_pruned):
+        """
+        Account for skipped entries.
+
+        Args:
+            num_pruned (int): number of entries skipped
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.num_pruned += num_pruned
+
+
+# ======================================================================
+def read_patterns(filepath):
+    """
+    Read patterns from a file.
+
+    Args:
+        filepath (str): path to the file, with one pattern per line.
+            Empty lines and lines starting with '#' are ignored.
+
+    Returns:
+        patterns (list[str]): the patterns
+    """
+    with open(filepath) as file_obj:
+        return [
+            line.rstrip('\r\n') for line in file_obj
+            if line.strip() and not line.startswith('#')]
+
+
+# ======================================================================
+class ScanThrottle(object):
+    """
+    Limiter of the rate of the metadata operations of a scan.
+
+    Uses a token bucket: each listing of a directory and each stat of an
+    entry costs one token, and tokens are refilled at the current rate up
+    to a small burst. Callers reserve their tokens and then sleep until
+    they are available, so that the rate holds across threads.
+    If adaptive, the current rate is halved whenever the average latency of
+    the operations rises above `slowdown` times the lowest observed, and
+    increased again (in steps of 10% of `rate`) while it stays low; the
+    rate is adjusted at most once per second.
+
+    Attributes:
+        rate (float): max number of operations per second
+        adaptive (bool): adapt the rate to the observed latency
+        slowdown (float): the latency increase that triggers a back-off
+        current_rate (float): the current number of operations per second
+        num_ops (int): number of operations
+        wait_time (float): total time spent waiting for tokens in seconds
+        latency (float|None): average latency of an operation in seconds
+        min_latency (float|None): lowest average latency in seconds
+        num_backoffs (int): number of times the rate was reduced
+    """
+
+    def __init__(self, rate, adaptive=False, slowdown=4.0):
+        """
+        Args:
+            rate (float): max number of operations per second
+            adaptive (bool): adapt the rate to the observed latency
+            slowdown (float): the latency increase that triggers a back-off
+        """
+        self.rate = rate
+        self.adaptive = adaptive
+        self.slowdown = slowdown
+        self.current_rate = rate
+        self.num_ops = 0
+        self.wait_time = 0.0
+        self.latency = None
+        self.min_latency = None
+        self.num_backoffs = 0
+        self._burst = max(1.0, rate / 10)
+        self._tokens = self._burst
+        self._begin_time = self._last_time = self._adjust_time = \
+            time.perf_counter()
+        self._lock = threading.Lock()
+
+    def acquire(self, num_ops=1):
+        """
+        Wait until the operations are allowed.
+
+        Args:
+            num_ops (int): number of operations
+
+        Returns:
+            None
+        """
+        with self._lock:
+            now = time.perf_counter()
+            self._tokens = min(
+                self._burst,
+                self._tokens + (now - self._last_time) * self.current_rate)
+            self._last_time = now
+            self._tokens -= num_ops
+            self.num_ops += num_ops
+            delay = -self._tokens / self.current_rate \
+                if self._tokens < 0 else 0.0
+            self.wait_time += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, elapsed, num_ops=1):
+        """
+        Account for the latency of operations (only used if adaptive).
+
+        Args:
+            elapsed (float): the duration of the operations in seconds
+            num_ops (int): number of operations
+
+        Returns:
+            None
+        """
+        if not self.adaptive or num_ops <= 0:
+            return
+        with self._lock:
+            latency = elapsed / num_ops
+            self.latency = latency if self.latency is None \
+                else 0.9 * self.latency + 0.1 * latency
+            if self.min_latency is None or self.latency < self.min_latency:
+                self.min_latency = self.latency
+            now = time.perf_counter()
+            if now - self._adjust_time < 1.0:
+                return
+            self._adjust_time = now
+            if self.latency > self.slowdown * self.min_latency:
+                self.current_rate = max(
+                    self.current_rate / 2, self.rate / 100)
+                self.num_backoffs += 1
+            else:
+                self.current_rate = min(
+                    self.current_rate + self.rate / 10, self.rate)
+
+    def effective_rate(self):
+        """
+        Compute the number of operations per second achieved so far.
+
+        Returns:
+            rate (float): the number of operations per second
+        """
+        elapsed = time.perf_counter() - self._begin_time
+        return self.num_ops / elapsed if elapsed > 0 else 0.0
+
+    def to_str(self):
+        """
+        Convert the throttling statistics to human-readable text.
+
+        Returns:
+            text (str): String containing the statistics
+        """
+        text = 'I: throttle: {} ops, effective rate: {:.0f}/s ' \
+            '(max: {:.0f}/s), waited: {:.3f}s'.format(
+                self.num_ops, self.effective_rate(), self.rate,
+                self.wait_time)
+        if self.adaptive:
+            text += ', back-offs: {}, final rate: {:.0f}/s'.format(
+                self.num_backoffs, self.current_rate)
+        return text
+
+
+# ======================================================================
+def set_idle_io_priority():
+    """
+    Set the I/O priority of the current process to idle (Linux only).
+
+    With the idle I/O scheduling class, the process only gets disk time
+    when no other process needs it (depending on the I/O scheduler).
+    Threads and processes started afterwards inherit the priority.
+
+    Returns:
+        result (bool): True if the priority was set
+    """
+    number = IOPRIO_SET_SYSCALLS.get(os.uname().machine) \
+        if sys.platform.startswith('linux') else None
+    if number is None:
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        result = libc.syscall(
+            number, IOPRIO_WHO_PROCESS, 0,
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    except (OSError, AttributeError, TypeError):
+        return False
+    return result == 0
+
+
+# ======================================================================
+def _scan_dir(
+        base,
+        base_dev,
+        follow_links,
+        follow_mounts,
+        allow_special,
+        allow_hidden,
+        on_error,
+        scan_stats=None,
+        dir_fd=None,
+        name_filter=None,
+        throttle=None):
+    """
+    List the allowed entries of a single directory.
+
+    Uses `os.scandir()` so that the file type cached in the directory entry
+    (if available) spares one system call per entry, and only a single
+    `stat`/`lstat` call is issued for each entry that passes the filters.
+    Mount points are detected by comparing the device of each entry with
+    the device of the containing directory.
+
+    Args:
+        base (str): directory where to operate
+        base_dev (int): device of `base` (as obtained by `os.stat()`)
+        follow_links (bool): follow links during recursion
+        follow_mounts (bool): follow mount points during recursion
+        allow_special (bool): include special files
+        allow_hidden (bool): include hidden files
+        on_error (callable): function to call on error
+        scan_stats (ScanStats|None): collector of scan statistics
+        dir_fd (int|None): file descriptor of `base`.
+            If specified, the entries are listed and stat'ed relative to it,
+            instead of resolving the path of each entry.
+        name_filter (NameFilter|None): filter of the entries by name
+        throttle (ScanThrottle|None): limiter of the rate of the listing
+            and of the stat calls
+
+    Returns:
+        result (list[tuple]): the (path, stats, is_dir) of each entry
+    """
+    if scan_stats is not None:
+        begin_time = time.perf_counter()
+    result = []
+    num_stat, num_errors, num_pruned = 0, 0, 0
+    exclude = name_filter.exclude if name_filter is not None else None
+    include = name_filter.include if name_filter is not None else None
+    if throttle is not None:
+        throttle.acquire()
+        call_time = time.perf_counter()
+    try:
+        entries = list(os.scandir(base if dir_fd is None else dir_fd))
+    except OSError as error:
+        if on_error is not None:
+            on_error(error)
+        if scan_stats is not None:
+            scan_stats.add_dir(
+                base, time.perf_counter() - begin_time, 0, 1, 0)
+        return result
+    if throttle is not None:
+        # the latency of a listing is comparable to that of a stat per entry
+        throttle.observe(time.perf_counter() - call_time, len(entries) or 1)
+    for entry in entries:
+        if not allow_hidden and entry.name.startswith('.'):
+            continue
+        if exclude is not None and exclude(entry.name):
+            num_pruned += 1
+            continue
+        try:
+            is_link = entry.is_symlink()
+            if is_link and not follow_links:
+                continue
+            num_stat += 1
+            if throttle is not None:
+                throttle.acquire()
+                call_time = time.perf_counter()
+                stats = entry.stat(follow_symlinks=follow_links)
+                throttle.observe(time.perf_counter() - call_time)
+            else:
+                stats = entry.stat(follow_symlinks=follow_links)
+        except OSError as error:
+            num_errors += 1
+            if on_error is not None:
+                on_error(error)
+            continue
+        mode = stats.st_mode
+        # links are never mount points (consistently with `os.path.ismount`)
+        if not follow_mounts and not is_link and stats.st_dev != base_dev:
+            continue
+        if not allow_special and _is_special(mode):
+            continue
+        is_dir = stat.S_ISDIR(mode)
+        if include is not None and not is_dir and not include(entry.name):
+            num_pruned += 1
+            continue
+        result.append((
+            entry.path if dir_fd is None else os.path.join(base, entry.name),
+            stats, is_dir))
+    if num_pruned:
+        name_filter.add_pruned(num_pruned)
+    if scan_stats is not None:
+        scan_stats.add_dir(
+            base, time.perf_counter() - begin_time, num_stat, num_errors,
+            len(result))
+    return result
+
+
+# ======================================================================
+def _shard_entries(entries, shard):
+    """
+    Keep the entries of a shard.
+
+    Entries are assigned to the shards by the CRC-32 of their name, so that
+    the assignment is the same on any machine.
+
+    Args:
+        entries (list[tuple]): the (path, stats, is_dir) of each entry
+        shard (tuple[int]): the index of the shard and the number of shards
+
+    Returns:
+        result (list[tuple]): the entries of the shard
+    """
+    index, num_shards = shard
+    return [
+        entry for entry in entries
+        if zlib.crc32(os.path.basename(entry[0]).encode(
+            'utf-8', 'surrogateescape')) % num_shards == index]
 
 
 # ======================================================================
-def _or_not_and_not(flag, check):
-    return flag or not flag and not check
+def _walk2_threads(
+        base,
+        base_dev,
+        scan_args,
+        workers,
+        max_depth=-1,
+        shard=None):
+    """
+    Yield the allowed paths below a directory using a pool of threads.
+
+    Each directory is an independent task (listing and stat of its entries)
+    submitted to the shared queue of the pool, so that any idle thread picks
+    up the next pending directory.
+    Results are collected in the calling thread as soon as each directory
+    is done; each directory is still yielded before its contents.
+
+    Args:
+        base (str): directory where to operate
+        base_dev (int): device of `base` (as obtained by `os.stat()`)
+        scan_args (tuple): additional arguments for `_scan_dir()`
+        workers (int): number of threads
+        max_depth (int): max depth of the entries (negative for unlimited)
+        shard (tuple[int]|None): only scan this shard of the contents of
+            `base`. See `walk2()` for more details.
+
+    Yields:
+        path (str): the path of the entry
+        stats (os.stat_result): the stats of the entry
+    """
+    done = queue.Queue()
+    stopped = []
+
+    def scan(path, dev, depth):
+        entries = _scan_dir(path, dev, *scan_args) if not stopped else []
+        if depth == 0 and shard is not None:
+            entries = _shard_entries(entries, shard)
+        return depth, entries
+
+    executor = concurrent.futures.ThreadPoolExecutor(workers)
+    try:
+        executor.submit(scan, base, base_dev, 0).add_done_callback(done.put)
+        num_pending = 1
+        while num_pending:
+            depth, entries = done.get().result()
+            num_pending -= 1
+            descend = max_depth < 0 or depth < max_depth
+            for path, stats, is_dir in entries:
+                yield path, stats
+                if is_dir and descend:
+                    executor.submit(scan, path, stats.st_dev, depth + 1) \
+                        .add_done_callback(done.put)
+                    num_pending += 1
+    finally:
+        # skip pending work if the consumer stops early
+        stopped.append(True)
+        executor.shutdown()
 
 
 # ======================================================================
@@ -92,8 +729,21 @@ def walk2(
         follow_mounts=False,
         allow_special=False,
         allow_hidden=True,
-        on_error=None):
+        on_error=None,
+        order='depth',
+        workers=1,
+        max_depth=-1,
+        scan_stats=None,
+        max_fds=0,
+        name_filter=None,
+        shard=None,
+        throttle=None):
     """
+    Recursively yield the allowed paths below a directory.
+
+    The traversal uses an explicit work list instead of nested generators,
+    so that the cost per entry does not depend on its depth.
+    Each directory is always yielded before its contents.
 
     Args:
         base (str): directory where to operate
@@ -102,281 +752,3754 @@ def walk2(
         allow_special (bool): include special files
         allow_hidden (bool): include hidden files
         on_error (callable): function to call on error
+        order (str): traversal order ['depth'|'breadth']
+            - 'depth': depth-first (each directory is followed by its
+              contents, like `find`)
+            - 'breadth': breadth-first (level by level)
+            Ignored if `workers` is larger than 1.
+        workers (int): number of threads used to list and stat entries.
+            If larger than 1, the order of the results is not defined,
+            except that each directory is yielded before its contents.
+            This is mostly useful for high-latency (e.g. network) filesystems.
+        max_depth (int): max depth of the entries (negative for unlimited).
+            The contents of `base` are at depth 0; the directories at
+            `max_depth` are yielded, but not descended into.
+        scan_stats (ScanStats|None): collector of scan statistics
+        max_fds (int): max number of directories kept open.
+            If positive, each directory is opened relative to its parent and
+            its entries are listed and stat'ed relative to it (like
+            `os.fwalk()`), so that the kernel does not resolve the whole
+            path of each entry, and renames of the parent directories during
+            the scan do not matter.
+            With breadth-first traversal, each directory is kept open until
+            its sub-directories are opened.
+            When the budget is exhausted, the directories whose
+            sub-directories are opened last are closed first: the closest
+            to `base` (depth-first) or the last listed (breadth-first), and
+            their remaining sub-directories are opened by path.
+            Since the kernel does not detect loops of links in this case,
+            links to an ancestor directory are not descended into.
+            Ignored if `workers` is larger than 1 or if not supported.
+        name_filter (NameFilter|None): filter of the entries by name.
+            Excluded directories are not descended into.
+        shard (tuple[int]|None): the index of the shard and the number of
+            shards. If specified, only the contents of `base` assigned to
+            the shard (by the hash of their name) are yielded and descended
+            into, so that the shards partition the tree.
+        throttle (ScanThrottle|None): limiter of the rate of the metadata
+            operations (shared by all the threads).
+            See `ScanThrottle` for more details.
 
-    Returns:
-
+    Yields:
+        path (str): the path of the entry
+        stats (os.stat_result): the stats of the entry (links are followed
+            only if `follow_links` is True)
     """
+    if order == 'depth':
+        depth_first = True
+    elif order == 'breadth':
+        depth_first = False
+    else:
+        depth_first = True
+        msg = '{}: unknown order. Fall back to: depth'.format(order)
+        warnings.warn(msg)
     try:
-        for name in os.listdir(base):
-            path = os.path.join(base, name)
-            stats = os.stat(path)
-            mode = stats.st_mode
-            # for some reasons, stat.S_ISLINK and os.path.islink results differ
-            allow = \
-                _or_not_and_not(follow_links, os.path.islink(path)) and \
-                _or_not_and_not(follow_mounts, os.path.ismount(path)) and \
-                _or_not_and_not(allow_special, _is_special(mode)) and \
-                _or_not_and_not(allow_hidden, _is_hidden(path))
-            if allow:
-                yield path, stats
-                if os.path.isdir(path):
-                    next_level = walk2(
-                        path, follow_links, follow_mounts,
-                        allow_special, allow_hidden, on_error)
-                    for next_path, next_stats in next_level:
-                        yield next_path, next_stats
-
+        base_stats = os.stat(base)
     except OSError as error:
         if on_error is not None:
             on_error(error)
         return
+    base_dev = base_stats.st_dev
+    if workers > 1:
+        scan_args = (
+            follow_links, follow_mounts, allow_special, allow_hidden,
+            on_error, scan_stats, None, name_filter, throttle)
+        for path, stats in _walk2_threads(
+                base, base_dev, scan_args, workers, max_depth, shard):
+            yield path, stats
+        return
+    use_fds = max_fds > 0 and os.scandir in os.supports_fd \
+        and os.open in os.supports_dir_fd
+    open_flags = os.O_RDONLY | os.O_DIRECTORY \
+        | (0 if follow_links else getattr(os, 'O_NOFOLLOW', 0))
+    check_loops = use_fds and follow_links
+    num_fds = 0
+    # each item is: [path, dev, iterator over the entries or None, depth,
+    #   file descriptor or None, parent item or None,
+    #   number of sub-directories not opened yet,
+    #   (dev, inode) of the directory and of its ancestors or None]
+    # the (dev, inode) are chained as: ((dev, inode), ancestors)
+    # entries are only listed when the directory is first reached
+    dirs = collections.deque([[
+        base, base_dev, None, 0, None, None, 0,
+        ((base_dev, base_stats.st_ino), None) if check_loops else None]])
+    # the listed directories kept open for their sub-directories (only for
+    # breadth-first traversal), in the order they were listed
+    parents = {}
+    try:
+        while dirs:
+            item = dirs[-1] if depth_first else dirs[0]
+            if item[2] is None:
+                if use_fds:
+                    parent = item[5]
+                    parent_fd = parent[4] if parent is not None else None
+                    try:
+                        item[4] = os.open(
+                            os.path.basename(item[0])
+                            if parent_fd is not None else item[0],
+                            open_flags, dir_fd=parent_fd)
+                    except OSError:
+                        # fall back to the path (and its error handling)
+                        pass
+                    else:
+                        num_fds += 1
+                    if parent is not None:
+                        parent[6] -= 1
+                        if not parent[6] and id(parent) in parents:
+                            del parents[id(parent)]
+                            if parent[4] is not None:
+                                os.close(parent[4])
+                                parent[4] = None
+                                num_fds -= 1
+                    # close the parents whose sub-directories come last
+                    while num_fds > max_fds and parents:
+                        other = parents.popitem()[1]
+                        if other[4] is not None:
+                            os.close(other[4])
+                            other[4] = None
+                            num_fds -= 1
+                    # close the directories closest to `base` first
+                    for other in dirs:
+                        if num_fds <= max_fds:
+                            break
+                        if other[4] is not None and other is not item:
+                            os.close(other[4])
+                            other[4] = None
+                            num_fds -= 1
+                    item[5] = None
+                entries = _scan_dir(
+                    item[0], item[1], follow_links, follow_mounts,
+                    allow_special, allow_hidden, on_error, scan_stats,
+                    item[4], name_filter, throttle)
+                if item[3] == 0 and shard is not None:
+                    entries = _shard_entries(entries, shard)
+                item[2] = iter(entries)
+            descend = max_depth < 0 or item[3] < max_depth
+            for path, stats, is_dir in item[2]:
+                yield path, stats
+                if is_dir and descend:
+                    ancestors = None
+                    if check_loops:
+                        key = stats.st_dev, stats.st_ino
+                        ancestors = item[7]
+                        while ancestors is not None and ancestors[0] != key:
+                            ancestors = ancestors[1]
+                        if ancestors is not None:
+                            # a link to an ancestor would loop forever
+                            continue
+                        ancestors = key, item[7]
+                    dirs.append(
+                        [path, stats.st_dev, None, item[3] + 1, None, item,
+                         0, ancestors])
+                    item[6] += 1
+                    if depth_first:
+                        break
+            else:
+                if depth_first:
+                    dirs.pop()
+                else:
+                    dirs.popleft()
+                if item[4] is not None:
+                    if item[6]:
+                        # the sub-directories are opened relative to it
+                        parents[id(item)] = item
+                    else:
+                        os.close(item[4])
+                        item[4] = None
+                        num_fds -= 1
+    finally:
+        for item in list(dirs) + list(parents.values()):
+            if item[4] is not None:
+                os.close(item[4])
 
 
 # ======================================================================
-def disk_usage(
-        base=os.getcwd(),
-        follow_links=True,
+async def async_walk2(
+        base,
+        follow_links=False,
         follow_mounts=False,
-        allow_special=True,
+        allow_special=False,
         allow_hidden=True,
-        only_dir=False,
-        max_depth=1,
-        verbose=D_VERB_LVL):
+        on_error=None,
+        workers=4,
+        max_depth=-1,
+        executor=None):
+    """
+    Recursively yield the allowed paths below a directory, asynchronously.
+
+    Same as `walk2()`, except that the directories are listed (and their
+    entries stat'ed) in an executor, so that the event loop is never
+    blocked by the filesystem.
+    The order of the results is not defined, except that each directory is
+    yielded before its contents.
+    If the consumer stops early (e.g. on cancellation), the pending listings
+    are cancelled (those already running complete in the background).
+
+    Args:
+        base (str): directory where to operate
+        follow_links (bool): follow links during recursion
+        follow_mounts (bool): follow mount points during recursion
+        allow_special (bool): include special files
+        allow_hidden (bool): include hidden files
+        on_error (callable): function to call on error.
+            It is called from the threads of the executor.
+        workers (int): max number of directories listed concurrently
+        max_depth (int): max depth of the entries (negative for unlimited).
+            See `walk2()` for more details.
+        executor (concurrent.futures.Executor|None): the executor to use.
+            If None, the default executor of the event loop is used.
+
+    Yields:
+        path (str): the path of the entry
+        stats (os.stat_result): the stats of the entry (links are followed
+            only if `follow_links` is True)
+    """
+    loop = asyncio.get_running_loop()
+
+    async def scan(path, dev, depth):
+        return depth, await loop.run_in_executor(
+            executor, _scan_dir, path, dev, follow_links, follow_mounts,
+            allow_special, allow_hidden, on_error)
+
+    try:
+        base_dev = (await loop.run_in_executor(executor, os.stat, base)).st_dev
+    except OSError as error:
+        if on_error is not None:
+            on_error(error)
+        return
+    dirs = collections.deque([(base, base_dev, 0)])
+    pending = set()
+    num_entries = 0
+    try:
+        while dirs or pending:
+            while dirs and len(pending) < workers:
+                pending.add(asyncio.ensure_future(scan(*dirs.popleft())))
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                depth, entries = task.result()
+                descend = max_depth < 0 or depth < max_depth
+                for path, stats, is_dir in entries:
+                    yield path, stats
+                    if is_dir and descend:
+                        dirs.append((path, stats.st_dev, depth + 1))
+                    # let other tasks run during large directories
+                    num_entries += 1
+                    if num_entries % 1024 == 0:
+                        await asyncio.sleep(0)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# ======================================================================
+def _get_size(stats, allocated=False):
+    return stats.st_blocks * 512 if allocated else stats.st_size
+
+
+# ======================================================================
+class InodeSet(object):
+    """
+    Compact set of (device, inode) pairs.
+
+    Inodes are stored in open-addressing hash tables (one per device) backed
+    by arrays of unsigned 64-bit integers, which take 8 bytes per slot
+    instead of the ~100 bytes per element of a `set` of tuples.
+    The value 0 (never a valid inode number) marks the empty slots.
+    The bits of the inode numbers are mixed (Fibonacci hashing) before
+    choosing the slots, so that runs of consecutive inode numbers do not
+    fill runs of adjacent slots.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        Args:
+            capacity (int): initial number of slots per device.
+                Must be a power of 2.
+        """
+        self._capacity = capacity
+        # device -> [slots, number of used slots]
+        self._tables = {}
+
+    def __len__(self):
+        return sum(used for slots, used in self._tables.values())
+
+    def __contains__(self, item):
+        dev, ino = item
+        table = self._tables.get(dev)
+        if table is None:
+            return False
+        slots = table[0]
+        mask = len(slots) - 1
+        shift = 65 - len(slots).bit_length()
+        i = (ino * _HASH_MULTIPLIER & _UINT64_MASK) >> shift
+        while slots[i]:
+            if slots[i] == ino:
+                return True
+            i = (i + 1) & mask
+        return False
+
+    def add(self, dev, ino):
+        """
+        Add an inode to the set.
+
+        Args:
+            dev (int): the device
+            ino (int): the inode number
+
+        Returns:
+            result (bool): True if the inode was not already in the set
+        """
+        table = self._tables.get(dev)
+        if table is None:
+            table = self._tables[dev] = \
+                [array.array('Q', bytes(8 * self._capacity)), 0]
+        slots = table[0]
+        mask = len(slots) - 1
+        shift = 65 - len(slots).bit_length()
+        i = (ino * _HASH_MULTIPLIER & _UINT64_MASK) >> shift
+        while slots[i]:
+            if slots[i] == ino:
+                return False
+            i = (i + 1) & mask
+        slots[i] = ino
+        table[1] += 1
+        # keep the load factor below 1/2
+        if 2 * table[1] > len(slots):
+            table[0] = self._resize(slots)
+        return True
+
+    @staticmethod
+    def _resize(slots):
+        new_slots = array.array('Q', bytes(16 * len(slots)))
+        mask = len(new_slots) - 1
+        shift = 65 - len(new_slots).bit_length()
+        for ino in slots:
+            if ino:
+                i = (ino * _HASH_MULTIPLIER & _UINT64_MASK) >> shift
+                while new_slots[i]:
+                    i = (i + 1) & mask
+                new_slots[i] = ino
+        return new_slots
+
+
+# ======================================================================
+class ScanCache(object):
+    """
+    Persistent cache of the contents of directories, backed by SQLite.
+
+    For each directory, the total size and the number of its (allowed)
+    non-directory entries are stored together with the names of its
+    (allowed) sub-directories and with a signature of the directory itself
+    (device, inode, modification and status change times).
+    A directory whose signature did not change does not need to be listed
+    again, and its entries do not need to be stat'ed.
+
+    Note that changes to the size of existing files do not affect the
+    signature of the containing directory, and therefore are only detected
+    after the directory itself changes (or the cache is cleared).
+
+    The cache file can be shared by concurrent scans: writes are committed
+    in small batches (in WAL mode, if supported), so that the database is
+    only locked briefly. If the database cannot be used (e.g. it stays
+    locked for longer than the timeout), the cache is disabled with a
+    warning and the scan continues without it.
+
+    Attributes:
+        filepath (str): the path to the cache file
+        max_size (int): max number of cached directories (negative for
+            unlimited)
+        batch_size (int): number of directories stored per transaction
+        num_hits (int): number of directories found unchanged in the cache
+        num_misses (int): number of directories that had to be listed
+        is_enabled (bool): False if the cache was disabled after an error
+    """
+
+    def __init__(
+            self, filepath=None, max_size=-1, clear=False, batch_size=256,
+            timeout=10.0):
+        """
+        Open (or create) the cache.
+
+        Args:
+            filepath (str|None): the path to the cache file.
+                If None, uses `D_CACHE_FILEPATH`.
+            max_size (int): max number of cached directories (negative for
+                unlimited)
+            clear (bool): remove all the previously cached contents
+            batch_size (int): number of directories stored per transaction
+            timeout (float): max time waiting for a lock in seconds
+        """
+        self.filepath = filepath if filepath else D_CACHE_FILEPATH
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.num_hits = 0
+        self.num_misses = 0
+        self.is_enabled = True
+        self._used = time.time()
+        self._hits = []
+        self._pending = []
+        self._conn = None
+        dirpath = os.path.dirname(os.path.realpath(self.filepath))
+        try:
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            self._conn = sqlite3.connect(self.filepath, timeout=timeout)
+            try:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                pass
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS dirs ('
+                ' path BLOB, opts INTEGER, signature TEXT,'
+                ' size INTEGER, num_files INTEGER, subdirs BLOB, used REAL,'
+                ' PRIMARY KEY (path, opts))')
+            if clear:
+                self._conn.execute('DELETE FROM dirs')
+            self._conn.commit()
+        except (OSError, sqlite3.DatabaseError) as error:
+            self._disable(error)
+
+    def _disable(self, error):
+        msg = '{}: cache disabled: {}'.format(self.filepath, error)
+        warnings.warn(msg)
+        self.is_enabled = False
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = None
+
+    def get(self, path, opts, signature):
+        """
+        Get the cached contents of a directory.
+
+        Args:
+            path (str): the path of the directory
+            opts (int): the options used for scanning (as a bit mask)
+            signature (str): the signature of the directory
+
+        Returns:
+            result (tuple|None): the cached contents, if still valid:
+                (size, num_files, subdirs), where subdirs is the list of
+                the names of the sub-directories.
+        """
+        key = os.fsencode(path)
+        row = None
+        if self.is_enabled:
+            try:
+                row = self._conn.execute(
+                    'SELECT signature, size, num_files, subdirs FROM dirs'
+                    ' WHERE path=? AND opts=?', (key, opts)).fetchone()
+            except sqlite3.DatabaseError as error:
+                self._disable(error)
+        if row is not None and row[0] == signature:
+            self.num_hits += 1
+            self._hits.append((self._used, key, opts))
+            subdirs = [os.fsdecode(name) for name in row[3].split(b'\0')] \
+                if row[3] else []
+            return row[1], row[2], subdirs
+        else:
+            self.num_misses += 1
+            return None
+
+    def put(self, path, opts, signature, size, num_files, subdirs):
+        """
+        Store the contents of a directory.
+
+        Args:
+            path (str): the path of the directory
+            opts (int): the options used for scanning (as a bit mask)
+            signature (str): the signature of the directory
+            size (int): the total size of the non-directory entries
+            num_files (int): the number of the non-directory entries
+            subdirs (list[str]): the names of the sub-directories
+
+        Returns:
+            None
+        """
+        if not self.is_enabled:
+            return
+        self._pending.append((
+            os.fsencode(path), opts, signature, size, num_files,
+            b'\0'.join(os.fsencode(name) for name in subdirs), self._used))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        # the lock is only held while writing a batch
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    self._pending)
+        except sqlite3.DatabaseError as error:
+            self._disable(error)
+        self._pending = []
+
+    def hit_ratio(self):
+        """
+        Compute the fraction of directories found in the cache.
+
+        Returns:
+            ratio (float): the hit ratio
+        """
+        num_total = self.num_hits + self.num_misses
+        return self.num_hits / num_total if num_total else 0.0
+
+    def close(self):
+        """
+        Write the cache to disk, enforcing its max size.
+
+        The least recently used directories are removed first.
+
+        Returns:
+            None
+        """
+        if self.is_enabled and self._pending:
+            self._flush()
+        if not self.is_enabled:
+            return
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    'UPDATE dirs SET used=? WHERE path=? AND opts=?',
+                    self._hits)
+                if self.max_size >= 0:
+                    self._conn.execute(
+                        'DELETE FROM dirs WHERE rowid IN ('
+                        ' SELECT rowid FROM dirs ORDER BY used DESC'
+                        ' LIMIT -1 OFFSET ?)', (self.max_size,))
+            self._hits = []
+            self._conn.close()
+            self._conn = None
+        except sqlite3.DatabaseError as error:
+            self._disable(error)
+
+
+# ======================================================================
+def _dir_signature(stats):
+    return '{}:{}:{}:{}'.format(
+        stats.st_dev, stats.st_ino, stats.st_mtime_ns, stats.st_ctime_ns)
+
+
+# ======================================================================
+def _cached_usage(
+        base,
+        base_stats,
+        cache,
+        end_time,
+        allocated,
+        follow_links,
+        follow_mounts,
+        allow_special,
+        allow_hidden,
+        on_error,
+        scan_stats=None,
+        name_filter=None,
+        throttle=None):
+    """
+    Compute the disk usage of the contents of a directory using a cache.
+
+    Only the directories that changed since they were cached are listed,
+    while each sub-directory of an unchanged directory only costs a single
+    `stat` call.
+
+    Args:
+        base (str): directory where to operate
+        base_stats (os.stat_result): the stats of `base`
+        cache (ScanCache): the cache
+        end_time (float|None): the time (as `time.perf_counter()`) after
+            which no more directories are visited
+        allocated (bool): use the allocated size instead of the apparent size
+        follow_links (bool): follow links during recursion
+        follow_mounts (bool): follow mount points during recursion
+        allow_special (bool): include special files
+        allow_hidden (bool): include hidden files
+        on_error (callable): function to call on error
+        scan_stats (ScanStats|None): collector of scan statistics
+        name_filter (NameFilter|None): filter of the entries by name
+        throttle (ScanThrottle|None): limiter of the rate of the metadata
+            operations
+
+    Returns:
+        total_size (int): total size of sub-files and sub-directories in bytes
+        num_files (int): total number of files
+        num_dirs (int): total number of dirs (excluding `base`)
+        is_complete (bool): False if `end_time` was reached
+    """
+    opts = follow_links | follow_mounts << 1 | allow_special << 2 \
+        | allow_hidden << 3 | allocated << 4 \
+        | (name_filter.signature << 5 if name_filter is not None else 0)
+    total_size, num_files, num_dirs = 0, 0, 0
+    dirs = [(base, base_stats)]
+    while dirs:
+        if end_time is not None and time.perf_counter() > end_time:
+            return total_size, num_files, num_dirs, False
+        path, stats = dirs.pop()
+        signature = _dir_signature(stats)
+        cached = cache.get(path, opts, signature)
+        if cached is not None:
+            size, num_sub_files, names = cached
+            if scan_stats is not None:
+                begin_time = time.perf_counter()
+            num_errors = 0
+            for name in names:
+                sub_path = os.path.join(path, name)
+                if throttle is not None:
+                    throttle.acquire()
+                try:
+                    sub_stats = os.stat(sub_path) if follow_links \
+                        else os.lstat(sub_path)
+                except OSError as error:
+                    num_errors += 1
+                    if on_error is not None:
+                        on_error(error)
+                    continue
+                if not follow_mounts and sub_stats.st_dev != stats.st_dev \
+                        and not os.path.islink(sub_path):
+                    continue
+                dirs.append((sub_path, sub_stats))
+            if scan_stats is not None:
+                scan_stats.add_dir(
+                    path, time.perf_counter() - begin_time, len(names),
+                    num_errors, len(names), False)
+        else:
+            size, num_sub_files, names = 0, 0, []
+            entries = _scan_dir(
+                path, stats.st_dev, follow_links, follow_mounts,
+                allow_special, allow_hidden, on_error, scan_stats, None,
+                name_filter, throttle)
+            for sub_path, sub_stats, is_dir in entries:
+                if is_dir:
+                    names.append(os.path.basename(sub_path))
+                    dirs.append((sub_path, sub_stats))
+                else:
+                    size += _get_size(sub_stats, allocated)
+                    num_sub_files += 1
+            cache.put(path, opts, signature, size, num_sub_files, names)
+        total_size += size
+        num_files += num_sub_files
+        if path != base:
+            total_size += _get_size(stats, allocated)
+            num_dirs += 1
+    return total_size, num_files, num_dirs, True
+
+
+# ======================================================================
+def _sampled_usage(
+        base,
+        base_stats,
+        fraction,
+        end_time,
+        allocated,
+        follow_links,
+        follow_mounts,
+        allow_special,
+        allow_hidden,
+        on_error,
+        scan_stats=None,
+        name_filter=None,
+        throttle=None):
+    """
+    Estimate the disk usage of the contents of a directory by sampling.
+
+    Every visited directory is listed, but only a simple random sample of
+    its sub-directories (the specified fraction, but at least 2, if
+    available) is descended into.
+    The totals of the sampled sub-directories are scaled up to all the
+    sub-directories (two-stage sampling estimator), and their spread
+    determines the variance of the estimate.
+    The samples are drawn with the `random` module (see `random.seed()`).
+
+    Args:
+        base (str): directory where to operate
+        base_stats (os.stat_result): the stats of `base`
+        fraction (float): fraction of sub-directories to sample
+        end_time (float|None): the time (as `time.perf_counter()`) after
+            which no more directories are visited
+        allocated (bool): use the allocated size instead of the apparent size
+        follow_links (bool): follow links during recursion
+        follow_mounts (bool): follow mount points during recursion
+        allow_special (bool): include special files
+        allow_hidden (bool): include hidden files
+        on_error (callable): function to call on error
+        scan_stats (ScanStats|None): collector of scan statistics
+        name_filter (NameFilter|None): filter of the entries by name
+        throttle (ScanThrottle|None): limiter of the rate of the metadata
+            operations
+
+    Returns:
+        total_size (int): estimated total size of sub-files and
+            sub-directories in bytes
+        num_files (int): estimated total number of files
+        num_dirs (int): estimated total number of dirs (excluding `base`)
+        variance (float): the variance of the estimated total size
+        is_complete (bool): False if `end_time` was reached
+    """
+    def visit(path, stats, size, num_dirs):
+        num_files, sub_dirs = 0, []
+        for sub_path, sub_stats, is_dir in _scan_dir(
+                path, stats.st_dev, follow_links, follow_mounts,
+                allow_special, allow_hidden, on_error, scan_stats, None,
+                name_filter, throttle):
+            if is_dir:
+                sub_dirs.append((sub_path, sub_stats))
+            else:
+                size += _get_size(sub_stats, allocated)
+                num_files += 1
+        num_samples = min(
+            len(sub_dirs), max(2, int(math.ceil(fraction * len(sub_dirs)))))
+        samples = random.sample(sub_dirs, num_samples) \
+            if num_samples < len(sub_dirs) else sub_dirs
+        return [
+            iter(samples), len(sub_dirs), num_samples, [],
+            size, num_files, num_dirs]
+
+    is_complete = True
+    frames = [visit(base, base_stats, 0, 0)]
+    while frames:
+        frame = frames[-1]
+        item = next(frame[0], None)
+        if item is not None and end_time is not None \
+                and time.perf_counter() > end_time:
+            is_complete = False
+            item = None
+        if item is not None:
+            sub_path, sub_stats = item
+            frames.append(
+                visit(sub_path, sub_stats, _get_size(sub_stats, allocated), 1))
+        else:
+            frames.pop()
+            _, num_sub_dirs, _, estimates, size, num_files, num_dirs = frame
+            # fewer samples are visited if `end_time` is reached
+            num_samples = len(estimates)
+            variance = 0.0
+            if estimates:
+                scale = num_sub_dirs / num_samples
+                sub_sizes = [estimate[0] for estimate in estimates]
+                size += scale * sum(sub_sizes)
+                num_files += scale * sum(estimate[1] for estimate in estimates)
+                num_dirs += scale * sum(estimate[2] for estimate in estimates)
+                variance += scale * sum(estimate[3] for estimate in estimates)
+                if 1 < num_samples < num_sub_dirs:
+                    mean_size = sum(sub_sizes) / len(sub_sizes)
+                    sub_variance = sum(
+                        (sub_size - mean_size) ** 2
+                        for sub_size in sub_sizes) / (len(sub_sizes) - 1)
+                    variance += num_sub_dirs ** 2 \
+                        * (1 - num_samples / num_sub_dirs) \
+                        * sub_variance / num_samples
+            if frames:
+                frames[-1][3].append((size, num_files, num_dirs, variance))
+            else:
+                return (
+                    int(round(size)), int(round(num_files)),
+                    int(round(num_dirs)), variance, is_complete)
+
+
+# ======================================================================
+class UsageEstimate(object):
+    """
+    Accuracy of the results of `disk_usage()`.
+
+    Sizes are exact, unless sub-directories were sampled or the scan was
+    stopped at its deadline (in which case the sizes are lower bounds).
+
+    Attributes:
+        confidence (float): the confidence level of the intervals
+        fraction (float): fraction of sub-directories sampled beyond the max
+            depth (1.0 if not sampled)
+        is_complete (bool): False if the scan was stopped at its deadline
+        deviations (dict): dictionary where the key is the subfolder,
+            relative (ending with the path separator) and the value is the
+            standard deviation of its estimated size in bytes.
+            Items not included have an exact size.
+        total_deviation (float): the standard deviation of the estimated
+            total size in bytes
+    """
+
+    def __init__(self, confidence=0.95):
+        """
+        Args:
+            confidence (float): the confidence level of the intervals
+        """
+        self.confidence = confidence
+        self.fraction = 1.0
+        self.is_complete = True
+        self.deviations = {}
+        self.total_deviation = 0.0
+
+    def interval(self, name=None):
+        """
+        Compute the half-width of the confidence interval of a size.
+
+        Assumes that the estimated sizes are normally distributed.
+
+        Args:
+            name (str|None): the item (as in the results of `disk_usage()`).
+                If None, the interval of the total size is computed.
+
+        Returns:
+            result (float): the half-width of the confidence interval in bytes
+        """
+        deviation = self.total_deviation if name is None \
+            else self.deviations.get(name, 0.0)
+        return statistics.NormalDist().inv_cdf(0.5 + self.confidence / 2) \
+            * deviation
+
+
+# ======================================================================
+class UsageTree(object):
+    """
+    Parent-index tree of the sizes of the entries below a directory.
+
+    Each node is stored by its position in a set of parallel lists, and
+    only the position of its parent is kept.
+    Nodes are created for the directories and the displayed entries up to
+    the maximum depth, while the size of any other entry is attributed to
+    its closest node, i.e. in O(depth) time per entry.
+    Since parents are always added before their children, the sizes of the
+    whole tree are accumulated bottom-up with a single reversed pass
+    (see `rollup()`).
+
+    To keep memory usage low, the numeric fields are stored in typed arrays
+    and the base names are interned (so that recurring names, e.g.
+    `__pycache__`, are stored only once), while full paths are only
+    reconstructed on demand (see `path()`).
+    Only the paths of the directories are indexed while adding entries, and
+    this index is dropped by `rollup()`.
+
+    Attributes:
+        max_depth (int): max depth of the nodes (negative for unlimited)
+        names (list[str]): the (interned) base name of each node
+        parents (array.array): the index of the parent of each node
+        sizes (array.array): the size of each node
+        flags (array.array): the flags of each node (see `DIR_FLAG`)
+    """
+    DIR_FLAG = 1
+
+    def __init__(self, max_depth=-1):
+        self.max_depth = max_depth
+        self.names = ['']
+        self.parents = array.array('q', [-1])
+        self.sizes = array.array('Q', [0])
+        self.flags = array.array('B', [self.DIR_FLAG])
+        # the index of the directory nodes, by their relative path
+        self._dirs = {'': 0}
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, subpath, size, is_dir, is_displayed=True):
+        """
+        Add an entry to the tree.
+
+        The parent directory of the entry must have been added before.
+
+        Args:
+            subpath (str): path of the entry, relative to the tree root
+            size (int): size of the entry in bytes
+            is_dir (bool): True if the entry is a directory
+            is_displayed (bool): True if the entry is to be displayed
+
+        Returns:
+            None
+        """
+        depth = subpath.count(os.path.sep)
+        if self.max_depth < 0 or depth < self.max_depth:
+            parent_path, name = os.path.split(subpath)
+            parent = self._dirs[parent_path]
+            if is_dir or is_displayed:
+                if is_dir:
+                    self._dirs[subpath] = len(self.names)
+                self.names.append(sys.intern(name))
+                self.parents.append(parent)
+                self.sizes.append(size)
+                self.flags.append(self.DIR_FLAG if is_dir else 0)
+            else:
+                self.sizes[parent] += size
+        else:
+            self.attribute(subpath, size)
+
+    def attribute(self, subpath, size):
+        """
+        Add a size to the closest node of a path.
+
+        Args:
+            subpath (str): path, relative to the tree root
+            size (int): size in bytes
+
+        Returns:
+            None
+        """
+        if self.max_depth >= 0:
+            # the ancestor at the max depth
+            subpath = os.path.sep.join(
+                subpath.split(os.path.sep, self.max_depth)[:self.max_depth])
+        self.sizes[self._dirs[subpath]] += size
+
+    def rollup(self):
+        """
+        Accumulate the size of each node into its ancestors.
+
+        No entry can be added afterwards.
+
+        Returns:
+            None
+        """
+        sizes = self.sizes
+        parents = self.parents
+        for i in range(len(sizes) - 1, 0, -1):
+            sizes[parents[i]] += sizes[i]
+        self._dirs = None
+
+    def is_dir(self, i):
+        """
+        Check if a node is a directory.
+
+        Args:
+            i (int): the index of the node
+
+        Returns:
+            result (bool): True if the node is a directory
+        """
+        return bool(self.flags[i] & self.DIR_FLAG)
+
+    def path(self, i):
+        """
+        Get the path of a node, relative to the tree root.
+
+        Args:
+            i (int): the index of the node
+
+        Returns:
+            path (str): the relative path of the node
+        """
+        names = []
+        while i > 0:
+            names.append(self.names[i])
+            i = self.parents[i]
+        return os.path.sep.join(reversed(names))
+
+    def items(self):
+        """
+        Iterate over the nodes (except the root).
+
+        Yields:
+            path (str): the relative path of the node
+            size (int): the size of the node
+            is_dir (bool): True if the node is a directory
+        """
+        for i in range(1, len(self.names)):
+            yield self.path(i), self.sizes[i], self.is_dir(i)
+
+    def children(self):
+        """
+        Group the nodes by their parent.
+
+        Uses a counting sort over the parents, i.e. O(n) time, and two
+        arrays instead of a list for each node.
+
+        Returns:
+            offsets (array.array): the start of the children of each node,
+                i.e. the children of node `i` are `order[offsets[i]:
+                offsets[i + 1]]`
+            order (array.array): the index of each node (except the root),
+                grouped by parent
+        """
+        num_nodes = len(self.names)
+        parents = self.parents
+        starts = array.array('q', bytes(8 * (num_nodes + 1)))
+        for i in range(1, num_nodes):
+            starts[parents[i] + 1] += 1
+        for i in range(num_nodes):
+            starts[i + 1] += starts[i]
+        offsets = array.array('q', starts)
+        order = array.array('q', bytes(8 * (num_nodes - 1)))
+        for i in range(1, num_nodes):
+            order[starts[parents[i]]] = i
+            starts[parents[i]] += 1
+        return offsets, order
+
+
+# ======================================================================
+class UsageItems(collections.abc.Mapping):
+    """
+    Read-only dict-like view of the nodes of a `UsageTree`.
+
+    The keys are the relative paths of the nodes (directories end with the
+    path separator) and the values are their sizes.
+    Iterating over the items does not require additional memory, while the
+    index required to look up single paths is only built on first access.
+    """
+
+    def __init__(self, tree):
+        """
+        Args:
+            tree (UsageTree): the tree, after `UsageTree.rollup()`
+        """
+        self.tree = tree
+        self._index = None
+
+    def _key(self, i):
+        path = self.tree.path(i)
+        return path + os.path.sep if self.tree.is_dir(i) else path
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def __iter__(self):
+        for i in range(1, len(self.tree)):
+            yield self._key(i)
+
+    def __getitem__(self, key):
+        if self._index is None:
+            self._index = {self._key(i): i for i in range(1, len(self.tree))}
+        return self.tree.sizes[self._index[key]]
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, dict(self.items()))
+
+    def items(self):
+        return _UsageItemsView(self)
+
+    def values(self):
+        return _UsageValuesView(self)
+
+
+# ======================================================================
+class _UsageItemsView(collections.abc.ItemsView):
+    def __iter__(self):
+        mapping = self._mapping
+        sizes = mapping.tree.sizes
+        for i in range(1, len(mapping.tree)):
+            yield mapping._key(i), sizes[i]
+
+
+# ======================================================================
+class _UsageValuesView(collections.abc.ValuesView):
+    def __iter__(self):
+        sizes = self._mapping.tree.sizes
+        for i in range(1, len(sizes)):
+            yield sizes[i]
+
+
+# ======================================================================
+class TopUsage(object):
+    """
+    Bounded-memory selection of the largest entries below a directory.
+
+    Offers the same interface as `UsageTree`, but only keeps the largest
+    (displayed) entries in a min-heap, together with the stack of the
+    directories currently being visited, whose sizes are accumulated as
+    their contents are added.
+    Requires the entries to be added in depth-first order (each directory
+    followed by its contents), so that a directory is complete as soon as
+    an entry outside of it is added.
+    Memory usage is O(num + depth).
+
+    Attributes:
+        num (int): max number of entries to keep
+        max_depth (int): max depth of the entries (negative for unlimited)
+        heap (list[tuple]): the (size, path, is_dir) of the largest entries
+    """
+
+    def __init__(self, num, max_depth=-1):
+        self.num = num
+        self.max_depth = max_depth
+        self.heap = []
+        # the [path, size, is_displayed] of the directories being visited
+        self._stack = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _push(self, size, subpath, is_dir):
+        if len(self.heap) < self.num:
+            heapq.heappush(self.heap, (size, subpath, is_dir))
+        elif size > self.heap[0][0]:
+            heapq.heappushpop(self.heap, (size, subpath, is_dir))
+
+    def _close(self, depth):
+        stack = self._stack
+        while len(stack) > depth:
+            subpath, size, is_displayed = stack.pop()
+            if stack:
+                stack[-1][1] += size
+            if is_displayed:
+                self._push(size, subpath, True)
+
+    def add(self, subpath, size, is_dir, is_displayed=True):
+        """
+        Add an entry.
+
+        See `UsageTree.add()` for more details.
+        """
+        depth = subpath.count(os.path.sep)
+        self._close(depth)
+        is_displayed = is_displayed \
+            and (self.max_depth < 0 or depth < self.max_depth)
+        if is_dir:
+            self._stack.append([subpath, size, is_displayed])
+        else:
+            if self._stack:
+                self._stack[-1][1] += size
+            if is_displayed:
+                self._push(size, subpath, False)
+
+    def attribute(self, subpath, size):
+        """
+        Add a size to a directory being visited (or its ancestors).
+
+        See `UsageTree.attribute()` for more details.
+        """
+        depth = subpath.count(os.path.sep) + 1 if subpath else 0
+        if depth and self._stack:
+            self._stack[min(depth, len(self._stack)) - 1][1] += size
+
+    def rollup(self):
+        """
+        Complete all the directories being visited.
+
+        Returns:
+            None
+        """
+        self._close(0)
+
+    def items(self):
+        """
+        Iterate over the largest entries (by decreasing size).
+
+        Yields:
+            path (str): the relative path of the entry
+            size (int): the size of the entry
+            is_dir (bool): True if the entry is a directory
+        """
+        for size, subpath, is_dir in sorted(self.heap, reverse=True):
+            yield subpath, size, is_dir
+
+
+# ======================================================================
+class ScanProgress(object):
+    """
+    Throttled reporter of the progress of a scan.
+
+    Shows the number of entries and bytes seen so far, the scanning rate and
+    the current directory on a single (continuously overwritten) line.
+    The clock is only checked every few entries, so that the overhead per
+    entry is negligible.
+
+    Attributes:
+        num_entries (int): number of entries seen so far
+        total_size (int): total size of the entries seen so far in bytes
+    """
+
+    def __init__(self, interval=0.5, units='unix', file=None):
+        """
+        Args:
+            interval (float): min time between updates in seconds
+            units (str): units to use ['iec'|'si'|'unix'|<exact>].
+                See 'humanize' for more details
+            file (file|None): the stream where to write (default: stderr)
+        """
+        self.interval = interval
+        self.units = units
+        self.file = file if file is not None else sys.stderr
+        self.num_entries = 0
+        self.total_size = 0
+        self._begin_time = self._last_time = time.time()
+        self._next_check = 64
+        self._len_line = 0
+
+    def update(self, path, size, num_entries=1):
+        """
+        Account for newly scanned entries.
+
+        Args:
+            path (str): the path of the (last) scanned entry
+            size (int): the size of the scanned entries in bytes
+            num_entries (int): the number of scanned entries
+
+        Returns:
+            None
+        """
+        self.num_entries += num_entries
+        self.total_size += size
+        if self.num_entries >= self._next_check:
+            self._next_check = self.num_entries + 64
+            now = time.time()
+            if now - self._last_time >= self.interval:
+                self._last_time = now
+                self.show(os.path.dirname(path), now)
+
+    def show(self, dirpath='', now=None):
+        """
+        Display the current progress.
+
+        Args:
+            dirpath (str): the directory being scanned
+            now (float|None): the current time (as given by `time.time()`)
+
+        Returns:
+            None
+        """
+        if now is None:
+            now = time.time()
+        elapsed = now - self._begin_time
+        rate = self.num_entries / elapsed if elapsed > 0 else 0.0
+        size_str, units_str = humanize(self.total_size, self.units)
+        line = '{} entries, {}{}, {:.0f} entries/s: {}'.format(
+            self.num_entries, size_str.strip(), units_str, rate, dirpath)
+        self.file.write('\r' + line.ljust(self._len_line))
+        self.file.flush()
+        self._len_line = len(line)
+
+    def close(self):
+        """
+        Clear the progress line.
+
+        Returns:
+            None
+        """
+        if self._len_line:
+            self.file.write('\r' + ' ' * self._len_line + '\r')
+            self.file.flush()
+            self._len_line = 0
+
+
+# ======================================================================
+def _open_snapshot(filepath, mode='r'):
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext == '.gz':
+        opener = gzip.open
+    elif ext == '.bz2':
+        opener = bz2.open
+    elif ext == '.xz':
+        opener = lzma.open
+    else:
+        opener = io.open
+    return opener(filepath, mode + 't', encoding='utf-8')
+
+
+# ======================================================================
+class SnapshotWriter(object):
+    """
+    Incremental writer of scan snapshots.
+
+    A snapshot is a newline-delimited JSON (NDJSON) file, optionally
+    compressed (depending on the extension: `.gz`, `.bz2` or `.xz`).
+    The first line is a header object with the path and the stats of the
+    base directory, followed by one array per entry: its path relative to
+    the base directory and its stats (see `SNAPSHOT_FIELDS`).
+    If the scan was incomplete (e.g. because of a deadline), the last line
+    is a trailer object marking it so.
+    Entries are written as soon as they are added, so that the memory usage
+    does not depend on the size of the snapshot.
+
+    Attributes:
+        filepath (str): the path to the snapshot file
+        num_entries (int): the number of entries written
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.num_entries = 0
+        self._file = None
+
+    def begin(self, base, base_stats):
+        """
+        Write the snapshot header.
+
+        Args:
+            base (str): the base directory
+            base_stats (os.stat_result): the stats of the base directory
+
+        Returns:
+            None
+        """
+        self._file = _open_snapshot(self.filepath, 'w')
+        header = dict(
+            hdu=__version__, base=os.path.realpath(base),
+            fields=SNAPSHOT_FIELDS, stats=_stats_to_list(base_stats))
+        self._file.write(json.dumps(header) + '\n')
+
+    def add(self, subpath, stats):
+        """
+        Write an entry.
+
+        Args:
+            subpath (str): the path of the entry, relative to the base
+            stats (os.stat_result): the stats of the entry
+
+        Returns:
+            None
+        """
+        self._file.write(
+            json.dumps([subpath] + _stats_to_list(stats),
+                       separators=(',', ':')) + '\n')
+        self.num_entries += 1
+
+    def end(self, is_complete=True):
+        """
+        Write the snapshot trailer (only if the scan was incomplete).
+
+        Args:
+            is_complete (bool): False if the scan was incomplete
+
+        Returns:
+            None
+        """
+        if not is_complete:
+            self._file.write(json.dumps(dict(is_complete=False)) + '\n')
+
+    def close(self):
+        """
+        Close the snapshot file.
+
+        Returns:
+            None
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# ======================================================================
+def _stats_to_list(stats):
+    return list(stats[:10]) + [stats.st_blocks]
+
+
+# ======================================================================
+def _list_to_stats(values):
+    return os.stat_result(values[:10], {'st_blocks': values[10]})
+
+
+# ======================================================================
+def read_snapshot(filepath):
+    """
+    Read a scan snapshot.
+
+    See `SnapshotWriter` for the format.
+
+    Args:
+        filepath (str): the path to the snapshot file
+
+    Returns:
+        base (str): the base directory of the snapshot
+        base_stats (os.stat_result): the stats of the base directory
+        paths (SnapshotPaths): the (path, stats) of each entry, like
+            `walk2()`. The entries are read lazily from the file.
+    """
+    snapshot_file = _open_snapshot(filepath)
+    header = json.loads(snapshot_file.readline())
+    base = header['base']
+    return base, _list_to_stats(header['stats']), \
+        SnapshotPaths(snapshot_file, base)
+
+
+# ======================================================================
+class SnapshotPaths(object):
+    """
+    Lazy iterable over the entries of a snapshot.
+
+    Attributes:
+        is_complete (bool): False if the snapshot is marked as incomplete.
+            Only known after all the entries were read.
+    """
+
+    def __init__(self, snapshot_file, base):
+        """
+        Args:
+            snapshot_file (file): the snapshot file (after the header)
+            base (str): the base directory of the snapshot
+        """
+        self.is_complete = True
+        self._file = snapshot_file
+        self._prefix = base if base.endswith(os.path.sep) \
+            else base + os.path.sep
+
+    def close(self):
+        """
+        Close the snapshot file (without reading the entries).
+
+        Returns:
+            None
+        """
+        self._file.close()
+
+    def __iter__(self):
+        with self._file:
+            for line in self._file:
+                values = json.loads(line)
+                if isinstance(values, dict):
+                    self.is_complete = values.get('is_complete', True)
+                    continue
+                yield self._prefix + values[0], _list_to_stats(values[1:])
+
+
+# ======================================================================
+def _filter_paths(paths, base, name_filter):
+    """
+    Filter the entries of a scan by name, like `walk2()` would.
+
+    Args:
+        paths (Iterable[tuple]): the (path, stats) of each entry
+        base (str): the base directory of the entries
+        name_filter (NameFilter): filter of the entries by name
+
+    Yields:
+        path (str): the path of the entry
+        stats (os.stat_result): the stats of the entry
+    """
+    exclude, include = name_filter.exclude, name_filter.include
+    len_base = len(base) + len(os.path.sep)
+    num_pruned = 0
+    for path, stats in paths:
+        names = path[len_base:].split(os.path.sep)
+        if exclude is not None and any(exclude(name) for name in names[:-1]):
+            # the contents of an excluded directory
+            continue
+        if exclude is not None and exclude(names[-1]) \
+                or include is not None and not stat.S_ISDIR(stats.st_mode) \
+                and not include(names[-1]):
+            num_pruned += 1
+            continue
+        yield path, stats
+    name_filter.add_pruned(num_pruned)
+
+
+# ======================================================================
+def disk_usage(
+        base=os.getcwd(),
+        follow_links=True,
+        follow_mounts=False,
+        allow_special=True,
+        allow_hidden=True,
+        only_dir=False,
+        max_depth=1,
+        verbose=D_VERB_LVL,
+        workers=1,
+        cache=None,
+        dedup_links=False,
+        allocated=False,
+        progress=None,
+        on_item=None,
+        top=0,
+        source=None,
+        export=None,
+        scan_stats=None,
+        sample=1.0,
+        deadline=None,
+        estimate=None,
+        max_fds=0,
+        name_filter=None,
+        nested=(),
+        aggregators=(),
+        shard=None,
+        throttle=None):
+    """
+    Display a human-friendly summary of disk usage.
+
+    Args:
+        base (str): directory where to operate
+        follow_links (bool): follow links during recursion
+        follow_mounts (bool): follow mount points during recursion
+        allow_special (bool): include special files
+        allow_hidden (bool): include hidden files
+        only_dir (bool): show only directories and not files
+        max_depth (int): max recursion depth (negative for unlimited)
+        verbose (int): set the level of verbosity
+        workers (int): number of threads used for scanning directories
+        cache (ScanCache|None): cache for the contents of the directories.
+            If specified, the contents of the directories beyond `max_depth`
+            are obtained from the cache, whenever they did not change.
+            Has no effect if `max_depth` is negative or `dedup_links` is True.
+        dedup_links (bool): count the size of hard-linked files only once
+        allocated (bool): use the allocated size (as 'du' does by default)
+            instead of the apparent size
+        progress (ScanProgress|None): reporter for the progress of the scan
+        on_item (callable|None): function called with the name and the size
+            of each displayed top-level item, as soon as it is complete.
+            With the default depth-first traversal this happens during the
+            scan; if `workers` is larger than 1 or `source` is specified
+            (whose order is not known), only at its end.
+        top (int): only keep the largest items up to this number.
+            If 0, keep all the items.
+            With the default depth-first traversal (i.e. unless `workers` is
+            larger than 1 or `source` is specified), memory usage does not
+            depend on the number of the items.
+        source (tuple|None): the (base_stats, paths) to use instead of
+            scanning `base`, where `paths` yields the (path, stats) of each
+            entry like `walk2()`, e.g. as obtained from `read_snapshot()`.
+            If specified, the options controlling the scan are ignored.
+            The results are incomplete if `paths` has a false
+            `is_complete` attribute (see `SnapshotPaths`).
+        export (SnapshotWriter|None): writer for a snapshot of the scan.
+            The snapshot includes all the entries, regardless of `max_depth`
+            (therefore, `cache` is not used).
+        scan_stats (ScanStats|None): collector of scan statistics
+        sample (float): fraction of sub-directories to visit beyond
+            `max_depth`, in the (0, 1] range.
+            If smaller than 1, the sizes of the directories at `max_depth`
+            (and, therefore, the totals) are estimated by sampling.
+            See `_sampled_usage()` for more details.
+            Has no effect if `max_depth` is negative, or if `source` or
+            `export` are specified; otherwise, `cache` is not used.
+        deadline (float|None): max duration of the scan in seconds.
+            If reached, the scan is stopped and the results are partial.
+        estimate (UsageEstimate|None): receives the accuracy of the results
+        max_fds (int): max number of directories kept open during the scan.
+            If positive, entries are stat'ed relative to their directory.
+            See `walk2()` for more details.
+        name_filter (NameFilter|None): filter of the entries by name.
+            Excluded directories are not descended into.
+            If `source` is specified, its entries are filtered the same way.
+        nested (Iterable[NestedUsage]): the directories below `base` whose
+            disk usage is also computed during the scan.
+            Ignored (i.e. not reached) if `cache` or `sample` are used.
+        aggregators (Iterable[UsageAggregator]): the aggregations computed
+            during the scan. These need all the entries, therefore `cache`
+            and `sample` are not used if specified.
+            See `UsageAggregator` for more details.
+        shard (tuple[int]|None): the index of the shard and the number of
+            shards. If specified, only the contents of `base` assigned to
+            the shard are scanned (see `walk2()`), and `base` itself only
+            counts in the first shard, so that the results of all the shards
+            can be merged with `merge_usage()`.
+            Ignored if `source` is specified; `sample` is not used.
+        throttle (ScanThrottle|None): limiter of the rate of the metadata
+            operations of the scan. See `ScanThrottle` for more details.
+
+    Returns:
+        items (Mapping): dictionary where the key is the subfolder, relative
+            (directories end with the path separator) and the value is the
+            size; unless `top` is specified, this is a read-only `UsageItems`
+            view backed by a compact `UsageTree`
+        total_size (int): total size of sub-files and sub-directories in bytes
+        num_files (int): total number of files
+        num_dirs (int): total number of dirs
+    """
+    if scan_stats is not None:
+        scan_stats.begin('disk_usage')
+    # snapshots may have been exported by a multi-threaded scan
+    is_depth_first = workers <= 1 and source is None
+    if top > 0 and is_depth_first:
+        tree = TopUsage(top, max_depth)
+    else:
+        tree = UsageTree(max_depth)
+    if source is not None:
+        base_stats, paths = source
+    else:
+        base_stats = os.stat(base)
+        paths = None
+    total_size = _get_size(base_stats, allocated)
+    num_files, num_dirs = 0, 1
+    if shard is not None and shard[0] != 0 and source is None:
+        total_size, num_dirs = 0, 0
+    inodes = InodeSet() if dedup_links else None
+    use_sample = sample < 1.0 and max_depth >= 0 and source is None \
+        and export is None and not aggregators and shard is None
+    use_cache = cache is not None and max_depth >= 0 and not dedup_links \
+        and source is None and export is None and not use_sample \
+        and not aggregators and (shard is None or max_depth > 0)
+    scan_args = (
+        allocated, follow_links, follow_mounts, allow_special, allow_hidden,
+        None, scan_stats, name_filter, throttle)
+    end_time = time.perf_counter() + deadline if deadline is not None \
+        else None
+    is_complete = True
+    # the variance of the estimated size of the directories at `max_depth`
+    variances = {}
+    if use_cache or use_sample:
+        # the entries beyond `max_depth` are not yielded by the walk
+        nested = ()
+    for nested_usage in nested:
+        if not nested_usage.subpath:
+            nested_usage.begin(total_size)
+
+    def frontier_usage(path, stats):
+        # the usage of the contents of a directory at `max_depth`
+        if use_sample:
+            return _sampled_usage(path, stats, sample, end_time, *scan_args)
+        else:
+            sizes = _cached_usage(path, stats, cache, end_time, *scan_args)
+            return sizes[:3] + (0.0, sizes[3])
+
+    if (use_cache or use_sample) and max_depth == 0:
+        paths = ()
+        sizes = frontier_usage(base, base_stats)
+        tree.attribute('', sizes[0])
+        total_size += sizes[0]
+        num_files += sizes[1]
+        num_dirs += sizes[2]
+        variances[''] = sizes[3]
+        is_complete = sizes[4]
+        if progress is not None:
+            progress.update(base, sizes[0], sizes[1] + sizes[2])
+    elif paths is None:
+        paths = walk2(
+            base, follow_links, follow_mounts, allow_special, allow_hidden,
+            workers=workers,
+            max_depth=max_depth - 1 if use_cache or use_sample else -1,
+            scan_stats=scan_stats, max_fds=max_fds, name_filter=name_filter,
+            shard=shard, throttle=throttle)
+    if base.endswith(os.path.sep):
+        base = base[:-len(os.path.sep)]
+    if source is not None and name_filter is not None:
+        paths = _filter_paths(paths, base, name_filter)
+    if export is not None:
+        export.begin(base, base_stats)
+    # the top-level item being scanned (for streaming)
+    stream = on_item is not None and max_depth != 0 and is_depth_first
+    top_name, top_size = None, 0
+    for path, stats in paths:
+        if end_time is not None and time.perf_counter() > end_time:
+            is_complete = False
+            break
+        size = _get_size(stats, allocated)
+        is_dir = stat.S_ISDIR(stats.st_mode)
+        if inodes is not None and stats.st_nlink > 1 and not is_dir \
+                and not inodes.add(stats.st_dev, stats.st_ino):
+            size = 0
+        if verbose >= VERB_LVL['debug']:
+            print(size, path)
+        subpath = path[len(base) + len(os.path.sep):]
+        if export is not None:
+            export.add(subpath, stats)
+        is_displayed = not only_dir or is_dir
+        if stream and os.path.sep not in subpath:
+            if top_name is not None:
+                on_item(top_name, top_size)
+            top_name = (subpath + os.path.sep if is_dir else subpath) \
+                if is_displayed else None
+            top_size = 0
+        tree.add(subpath, size, is_dir, is_displayed)
+        for nested_usage in nested:
+            nested_usage.add(subpath, size, is_dir, is_displayed)
+        for aggregator in aggregators:
+            aggregator.add(subpath, stats, size)
+        total_size += size
+        top_size += size
+        if progress is not None:
+            progress.update(path, size)
+        if is_dir:
+            num_dirs += 1
+            if (use_cache or use_sample) \
+                    and subpath.count(os.path.sep) == max_depth - 1:
+                sizes = frontier_usage(path, stats)
+                tree.attribute(subpath, sizes[0])
+                total_size += sizes[0]
+                top_size += sizes[0]
+                num_files += sizes[1]
+                num_dirs += sizes[2]
+                variances[subpath] = sizes[3]
+                is_complete = is_complete and sizes[4]
+                if progress is not None:
+                    progress.update(path, sizes[0], sizes[1] + sizes[2])
+        else:
+            num_files += 1
+    if stream and top_name is not None:
+        on_item(top_name, top_size)
+    if source is not None:
+        is_complete = is_complete \
+            and getattr(source[1], 'is_complete', True)
+    if export is not None:
+        export.end(is_complete)
+    tree.rollup()
+    if on_item is not None and not stream and max_depth != 0:
+        # only the UsageTree is used when not streaming
+        for i in range(1, len(tree)):
+            if tree.parents[i] == 0:
+                on_item(
+                    tree.names[i] + (os.path.sep if tree.is_dir(i) else ''),
+                    tree.sizes[i])
+    if use_cache and verbose >= VERB_LVL['high']:
+        print('I: cache: {} hit(s), {} miss(es), hit ratio: {:.1%}'.format(
+            cache.num_hits, cache.num_misses, cache.hit_ratio()))
+    if name_filter is not None and verbose >= VERB_LVL['medium']:
+        print('I: pruned: {} entries'.format(name_filter.num_pruned))
+    if throttle is not None and verbose >= VERB_LVL['medium']:
+        print(throttle.to_str())
+    if estimate is not None:
+        # the variance of a directory is the sum of those of its contents
+        deviations = {}
+        for subpath, variance in variances.items():
+            names = subpath.split(os.path.sep) if subpath else []
+            for i in range(1, len(names) + 1):
+                name = os.path.sep.join(names[:i]) + os.path.sep
+                deviations[name] = deviations.get(name, 0.0) + variance
+        estimate.fraction = sample if use_sample else 1.0
+        estimate.is_complete = is_complete
+        estimate.deviations = {
+            name: math.sqrt(variance)
+            for name, variance in deviations.items()}
+        estimate.total_deviation = math.sqrt(sum(variances.values()))
+    items = _usage_items(tree, top)
+    if scan_stats is not None:
+        scan_stats.end('disk_usage')
+    return items, total_size, num_files, num_dirs
+
+
+# ======================================================================
+def _usage_items(tree, top=0):
+    """
+    Get the items of a tree as returned by `disk_usage()`.
+
+    Args:
+        tree (UsageTree|TopUsage): the tree (after rollup)
+        top (int): only keep the largest items up to this number (0 for all)
+
+    Returns:
+        items (Mapping): the items. See `disk_usage()` for more details.
+    """
+    if isinstance(tree, UsageTree) and top <= 0:
+        return UsageItems(tree)
+    tree_items = tree.items()
+    if top > 0 and isinstance(tree, UsageTree):
+        tree_items = heapq.nlargest(top, tree_items, key=lambda x: x[1])
+    return {
+        name + os.path.sep if is_dir else name: size
+        for name, size, is_dir in tree_items}
+
+
+# ======================================================================
+class NestedUsage(object):
+    """
+    Disk usage of a directory nested in the directory being scanned.
+
+    Collects the entries below the nested directory while scanning the
+    outer directory (see `disk_usage()`), so that a single scan is needed
+    for both, with the same results as scanning them separately.
+    The nested directory may not be reached by the scan (e.g. if it is
+    hidden, excluded or on another device), in which case it must be
+    scanned separately.
+
+    Attributes:
+        subpath (str): the nested directory, relative to the outer one
+        base (str|None): the nested directory, as specified by the user
+        is_found (bool): True if the nested directory was reached
+        tree (UsageTree|TopUsage): the tree of the nested directory
+        total_size (int): total size of sub-files and sub-directories in bytes
+        num_files (int): total number of files
+        num_dirs (int): total number of dirs
+        lines (Iterable[str]|None): the rendered report (if any)
+    """
+
+    def __init__(self, subpath, max_depth=1, top=0, workers=1, base=None):
+        """
+        Args:
+            subpath (str): the nested directory, relative to the outer one
+                (empty for the outer directory itself)
+            max_depth (int): max recursion depth (negative for unlimited)
+            top (int): only keep the largest items up to this number
+            workers (int): number of threads used for scanning directories
+            base (str|None): the nested directory, as specified by the user
+        """
+        self.subpath = subpath
+        self.base = base
+        self.top = top
+        self.tree = TopUsage(top, max_depth) if top > 0 and workers <= 1 \
+            else UsageTree(max_depth)
+        self.is_found = False
+        self.total_size = 0
+        self.num_files = 0
+        self.num_dirs = 1
+        self.lines = None
+        self._prefix = subpath + os.path.sep if subpath else ''
+
+    def begin(self, size):
+        """
+        Mark the nested directory as reached.
+
+        Args:
+            size (int): the size of the nested directory itself in bytes
+
+        Returns:
+            None
+        """
+        self.is_found = True
+        self.total_size += size
+
+    def add(self, subpath, size, is_dir, is_displayed):
+        """
+        Add an entry of the scan, if below the nested directory.
+
+        Args:
+            subpath (str): path of the entry, relative to the outer directory
+            size (int): size of the entry in bytes
+            is_dir (bool): True if the entry is a directory
+            is_displayed (bool): True if the entry is to be displayed
+
+        Returns:
+            None
+        """
+        if self.is_found and subpath.startswith(self._prefix):
+            self.tree.add(
+                subpath[len(self._prefix):], size, is_dir, is_displayed)
+            self.total_size += size
+            if is_dir:
+                self.num_dirs += 1
+            else:
+                self.num_files += 1
+        elif is_dir and subpath == self.subpath:
+            self.begin(size)
+
+    def result(self):
+        """
+        Get the disk usage of the nested directory.
+
+        Returns:
+            result (tuple): the disk usage, like `disk_usage()`
+        """
+        self.tree.rollup()
+        return (
+            _usage_items(self.tree, self.top), self.total_size,
+            self.num_files, self.num_dirs)
+
+
+# ======================================================================
+class UsageAggregator(object):
+    """
+    Aggregation of the entries of a scan by a key (e.g. the owner).
+
+    Aggregators consume the entries yielded by the scan (see `disk_usage()`),
+    so that any number of aggregations can be computed in a single pass.
+    Subclasses must implement `key()` and may override `label()` and
+    `items()`; new aggregators can be made available from the command line
+    by adding them to `AGGREGATORS`.
+
+    Attributes:
+        title (str): the description of the aggregation
+        only_files (bool): skip the directories
+        sizes (dict): the total size in bytes of the entries of each key
+        counts (dict): the number of the entries of each key
+    """
+    title = ''
+
+    def __init__(self, only_files=True):
+        """
+        Args:
+            only_files (bool): skip the directories
+        """
+        self.only_files = only_files
+        self.sizes = {}
+        self.counts = {}
+
+    def key(self, subpath, stats, size):
+        """
+        Get the key of an entry.
+
+        Args:
+            subpath (str): path of the entry, relative to the base
+            stats (os.stat_result): the stats of the entry
+            size (int): size of the entry in bytes
+
+        Returns:
+            key (Hashable): the key of the entry
+        """
+        raise NotImplementedError
+
+    def label(self, key, units='iec'):
+        """
+        Get the displayed label of a key.
+
+        Args:
+            key (Hashable): the key
+            units (str): units of the sizes. See `humanize()`.
+
+        Returns:
+            label (str): the label
+        """
+        return str(key)
+
+    def add(self, subpath, stats, size):
+        """
+        Add an entry of the scan.
+
+        Args:
+            subpath (str): path of the entry, relative to the base
+            stats (os.stat_result): the stats of the entry
+            size (int): size of the entry in bytes
+
+        Returns:
+            None
+        """
+        if self.only_files and stat.S_ISDIR(stats.st_mode):
+            return
+        key = self.key(subpath, stats, size)
+        self.sizes[key] = self.sizes.get(key, 0) + size
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def items(self):
+        """
+        Get the keys in display order (the largest first).
+
+        Returns:
+            keys (list): the keys
+        """
+        return sorted(self.sizes, key=lambda x: (-self.sizes[x], str(x)))
+
+
+# ======================================================================
+class OwnerAggregator(UsageAggregator):
+    """
+    Aggregation by the owner (user or group) of the entries.
+    """
+
+    def __init__(self, by='uid'):
+        """
+        Args:
+            by (str): the owner: 'uid' for the user, 'gid' for the group
+        """
+        UsageAggregator.__init__(self, only_files=False)
+        self.by = by
+        self.title = 'by user' if by == 'uid' else 'by group'
+
+    def key(self, subpath, stats, size):
+        return stats.st_uid if self.by == 'uid' else stats.st_gid
+
+    def label(self, key, units='iec'):
+        try:
+            if self.by == 'uid':
+                return pwd.getpwuid(key).pw_name
+            else:
+                return grp.getgrgid(key).gr_name
+        except (AttributeError, KeyError):
+            return str(key)
+
+
+# ======================================================================
+class ExtensionAggregator(UsageAggregator):
+    """
+    Aggregation of the files by the extension of their name (lowercase).
+    """
+    title = 'by extension'
+
+    def key(self, subpath, stats, size):
+        return os.path.splitext(os.path.basename(subpath))[1].lower()
+
+    def label(self, key, units='iec'):
+        return key if key else '(none)'
+
+
+# ======================================================================
+class AgeAggregator(UsageAggregator):
+    """
+    Aggregation of the files by the age of their modification or access.
+
+    Attributes:
+        field (str): the time used: 'mtime' or 'atime'
+        buckets (tuple[tuple[float, str]]): the upper bound in seconds and
+            the name of each age bucket (in increasing order)
+        now (float): the reference time in seconds since the epoch
+    """
+
+    def __init__(self, field='mtime', buckets=AGE_BUCKETS, now=None):
+        """
+        Args:
+            field (str): the time used: 'mtime' or 'atime'
+            buckets (tuple[tuple[float, str]]): the upper bound in seconds
+                and the name of each age bucket (in increasing order)
+            now (float|None): the reference time in seconds since the epoch.
+                If None, the current time is used.
+        """
+        UsageAggregator.__init__(self)
+        self.field = 'st_' + field
+        self.title = 'by age of ' + field
+        self.buckets = buckets
+        self.now = time.time() if now is None else now
+        self._bounds = [bound for bound, name in buckets]
+
+    def key(self, subpath, stats, size):
+        return bisect.bisect_right(
+            self._bounds, self.now - getattr(stats, self.field))
+
+    def label(self, key, units='iec'):
+        if key == 0:
+            return '< ' + self.buckets[0][1]
+        elif key == len(self.buckets):
+            return '>= ' + self.buckets[-1][1]
+        else:
+            return '{} - {}'.format(
+                self.buckets[key - 1][1], self.buckets[key][1])
+
+    def items(self):
+        return sorted(self.sizes)
+
+
+# ======================================================================
+class SizeAggregator(UsageAggregator):
+    """
+    Aggregation of the files by their size, in power-of-2 buckets.
+
+    The bucket `n` contains the sizes in the [2^(n - 1), 2^n) range.
+    """
+    title = 'by size'
+
+    def key(self, subpath, stats, size):
+        return size.bit_length()
+
+    def label(self, key, units='iec'):
+        if key == 0:
+            return '0'
+        else:
+            return '{} - {}'.format(*(
+                ''.join(humanize(2 ** n, units)).strip()
+                for n in (key - 1, key)))
+
+    def items(self):
+        return sorted(self.sizes)
+
+
+# ======================================================================
+# :: the aggregators available from the command line
+AGGREGATORS = {
+    'uid': functools.partial(OwnerAggregator, 'uid'),
+    'gid': functools.partial(OwnerAggregator, 'gid'),
+    'ext': ExtensionAggregator,
+    'mtime': functools.partial(AgeAggregator, 'mtime'),
+    'atime': functools.partial(AgeAggregator, 'atime'),
+    'size': SizeAggregator,
+}
+
+
+# ======================================================================
+async def async_disk_usage(
+        base=os.getcwd(),
+        follow_links=True,
+        follow_mounts=False,
+        allow_special=True,
+        allow_hidden=True,
+        only_dir=False,
+        max_depth=1,
+        workers=4,
+        dedup_links=False,
+        allocated=False,
+        top=0,
+        executor=None,
+        on_partial=None,
+        interval=1.0,
+        deadline=None,
+        estimate=None):
+    """
+    Compute the disk usage asynchronously.
+
+    Same as `disk_usage()`, except that the filesystem is accessed in an
+    executor (see `async_walk2()`), so that it can be used from an event
+    loop.
+    The scan can be cancelled (or limited with `asyncio.wait_for()`), in
+    which case no result is available; alternatively, `deadline` stops the
+    scan and returns the partial results.
+
+    Args:
+        base (str): directory where to operate
+        follow_links (bool): follow links during recursion
+        follow_mounts (bool): follow mount points during recursion
+        allow_special (bool): include special files
+        allow_hidden (bool): include hidden files
+        only_dir (bool): show only directories and not files
+        max_depth (int): max recursion depth (negative for unlimited)
+        workers (int): max number of directories listed concurrently
+        dedup_links (bool): count the size of hard-linked files only once
+        allocated (bool): use the allocated size (as 'du' does by default)
+            instead of the apparent size
+        top (int): only keep the largest items up to this number.
+            If 0, keep all the items.
+        executor (concurrent.futures.Executor|None): the executor to use.
+            If None, the default executor of the event loop is used.
+        on_partial (callable|None): function called with the total size,
+            the number of files and the number of dirs found so far, at most
+            every `interval` seconds during the scan
+        interval (float): min time between calls to `on_partial` in seconds
+        deadline (float|None): max duration of the scan in seconds.
+            If reached, the scan is stopped and the results are partial.
+        estimate (UsageEstimate|None): receives the accuracy of the results
+
+    Returns:
+        items (Mapping): dictionary where the key is the subfolder, relative
+            (directories end with the path separator) and the value is the
+            size. See `disk_usage()` for more details.
+        total_size (int): total size of sub-files and sub-directories in bytes
+        num_files (int): total number of files
+        num_dirs (int): total number of dirs
+    """
+    loop = asyncio.get_running_loop()
+    begin_time = time.perf_counter()
+    end_time = begin_time + deadline if deadline is not None else None
+    last_time = begin_time
+    tree = UsageTree(max_depth)
+    base_stats = await loop.run_in_executor(executor, os.stat, base)
+    total_size = _get_size(base_stats, allocated)
+    num_files, num_dirs = 0, 1
+    inodes = InodeSet() if dedup_links else None
+    is_complete = True
+    paths = async_walk2(
+        base, follow_links, follow_mounts, allow_special, allow_hidden,
+        workers=workers, executor=executor)
+    if base.endswith(os.path.sep):
+        base = base[:-len(os.path.sep)]
+    try:
+        async for path, stats in paths:
+            if end_time is not None or on_partial is not None:
+                now = time.perf_counter()
+                if end_time is not None and now > end_time:
+                    is_complete = False
+                    break
+                if on_partial is not None and now - last_time >= interval:
+                    on_partial(total_size, num_files, num_dirs)
+                    last_time = now
+            size = _get_size(stats, allocated)
+            is_dir = stat.S_ISDIR(stats.st_mode)
+            if inodes is not None and stats.st_nlink > 1 and not is_dir \
+                    and not inodes.add(stats.st_dev, stats.st_ino):
+                size = 0
+            subpath = path[len(base) + len(os.path.sep):]
+            tree.add(subpath, size, is_dir, not only_dir or is_dir)
+            total_size += size
+            if is_dir:
+                num_dirs += 1
+            else:
+                num_files += 1
+    finally:
+        await paths.aclose()
+    tree.rollup()
+    if estimate is not None:
+        estimate.is_complete = is_complete
+    return _usage_items(tree, top), total_size, num_files, num_dirs
+
+
+# ======================================================================
+class _Inotify(object):
+    """
+    Minimal binding (through `ctypes`) to the Linux inotify API.
+
+    Raises:
+        OSError: if inotify is not available or cannot be initialized
+    """
+
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(
+                ctypes.util.find_library('c'), use_errno=True)
+            self._init = self._libc.inotify_init1
+            self._add_watch = self._libc.inotify_add_watch
+            self._rm_watch = self._libc.inotify_rm_watch
+        except (OSError, AttributeError, TypeError):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self._add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self._init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    @staticmethod
+    def _raise(path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def add_watch(self, path, mask=INOTIFY_MASK):
+        """
+        Watch a directory.
+
+        Args:
+            path (str): the directory
+            mask (int): the events to watch
+
+        Returns:
+            wd (int): the watch descriptor
+
+        Raises:
+            OSError: if the watch cannot be added (e.g. with ENOSPC, when the
+                max number of watches is reached)
+        """
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Stop watching a directory.
+
+        Args:
+            wd (int): the watch descriptor
+
+        Returns:
+            None
+        """
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        Read the pending events.
+
+        Args:
+            timeout (float): max time to wait for events in seconds
+
+        Returns:
+            events (list[tuple]): the (wd, mask, name) of each event
+        """
+        events = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return events
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+        i = 0
+        while i < len(data):
+            wd, mask, _, size = _INOTIFY_EVENT.unpack_from(data, i)
+            i += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[i:i + size].rstrip(b'\0'))
+            i += size
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        """
+        Close the inotify instance.
+
+        Returns:
+            None
+        """
+        os.close(self.fd)
+
+
+# ======================================================================
+class UsageWatch(object):
+    """
+    Disk usage kept up to date with the changes of the filesystem.
+
+    After an initial scan, the directories are watched with inotify and only
+    the entries that changed are stat'ed again (or, for new directories,
+    scanned), updating the totals incrementally.
+    The directories that cannot be watched (e.g. when the max number of
+    watches is reached, or if inotify is not available) are listed again
+    whenever their modification time changes; note that this only detects
+    added, removed or renamed entries.
+
+    The size of each entry is kept in memory, therefore the memory usage is
+    proportional to the number of entries.
+    Hard links are not deduplicated.
+
+    Attributes:
+        total_size (int): total size of sub-files and sub-directories in bytes
+        num_files (int): total number of files
+        num_dirs (int): total number of dirs
+        num_unwatched (int): number of directories not watched by inotify
+    """
+
+    def __init__(
+            self,
+            base,
+            follow_links=False,
+            follow_mounts=False,
+            allow_special=False,
+            allow_hidden=True,
+            only_dir=False,
+            max_depth=1,
+            allocated=False,
+            name_filter=None):
+        """
+        Args:
+            base (str): directory where to operate
+            follow_links (bool): follow links during recursion
+            follow_mounts (bool): follow mount points during recursion
+            allow_special (bool): include special files
+            allow_hidden (bool): include hidden files
+            only_dir (bool): show only directories and not files
+            max_depth (int): max recursion depth (negative for unlimited)
+            allocated (bool): use the allocated size instead of the apparent
+                size
+            name_filter (NameFilter|None): filter of the entries by name
+        """
+        self.base = base
+        self.follow_links = follow_links
+        self.follow_mounts = follow_mounts
+        self.allow_special = allow_special
+        self.allow_hidden = allow_hidden
+        self.only_dir = only_dir
+        self.max_depth = max_depth
+        self.allocated = allocated
+        self.name_filter = name_filter
+        self.total_size = 0
+        self.num_files = 0
+        self.num_dirs = 0
+        # the size of each entry (excluding the contents of directories)
+        self._sizes = {}
+        # the names of the contents and the device of each directory
+        self._children = {}
+        self._devs = {}
+        # the totals of the displayed items (up to `max_depth`)
+        self._totals = {}
+        # the watch descriptor of the watched directories (and vice versa)
+        self._wds = {}
+        self._subpaths = {}
+        # the last modification time of the directories not watched
+        self._mtimes = {}
+        try:
+            self._inotify = _Inotify()
+        except OSError:
+            self._inotify = None
+
+    @property
+    def num_unwatched(self):
+        return len(self._mtimes)
+
+    def _path(self, subpath):
+        return os.path.join(self.base, subpath) if subpath else self.base
+
+    def _subpath(self, path, base_path):
+        # the path relative to `base_path` (as obtained from `walk2()`)
+        return path[len(base_path.rstrip(os.path.sep)) + len(os.path.sep):]
+
+    def _credit(self, subpath, delta):
+        self.total_size += delta
+        names = subpath.split(os.path.sep) if subpath else []
+        if self.max_depth >= 0:
+            names = names[:self.max_depth]
+        for i in range(1, len(names) + 1):
+            name = os.path.sep.join(names[:i])
+            self._totals[name] = self._totals.get(name, 0) + delta
+
+    def _watch(self, subpath, stats):
+        if self._inotify is not None:
+            try:
+                wd = self._inotify.add_watch(self._path(subpath))
+            except OSError:
+                pass
+            else:
+                # a moved directory keeps its watch descriptor
+                self._wds[subpath] = wd
+                self._subpaths[wd] = subpath
+                return
+        self._mtimes[subpath] = stats.st_mtime_ns
+
+    def _unwatch(self, subpath):
+        wd = self._wds.pop(subpath, None)
+        if wd is not None and self._subpaths.get(wd) == subpath:
+            self._inotify.rm_watch(wd)
+            del self._subpaths[wd]
+        self._mtimes.pop(subpath, None)
+
+    def _stat(self, subpath):
+        # the stats of an entry, if allowed (same rules as `_scan_dir()`)
+        parent, name = os.path.split(subpath)
+        if not self.allow_hidden and name.startswith('.'):
+            return None
+        name_filter = self.name_filter
+        if name_filter is not None and name_filter.exclude is not None \
+                and name_filter.exclude(name):
+            return None
+        path = self._path(subpath)
+        try:
+            stats = os.lstat(path)
+            is_link = stat.S_ISLNK(stats.st_mode)
+            if is_link:
+                if not self.follow_links:
+                    return None
+                stats = os.stat(path)
+        except OSError:
+            return None
+        if not self.follow_mounts and not is_link \
+                and stats.st_dev != self._devs[parent]:
+            return None
+        if not self.allow_special and _is_special(stats.st_mode):
+            return None
+        if name_filter is not None and name_filter.include is not None \
+                and not stat.S_ISDIR(stats.st_mode) \
+                and not name_filter.include(name):
+            return None
+        return stats
+
+    def _add(self, subpath, stats):
+        is_dir = stat.S_ISDIR(stats.st_mode)
+        size = _get_size(stats, self.allocated)
+        self._children[os.path.dirname(subpath)].add(
+            os.path.basename(subpath))
+        self._sizes[subpath] = size
+        if is_dir:
+            self._children[subpath] = set()
+            self._devs[subpath] = stats.st_dev
+            self._watch(subpath, stats)
+            self.num_dirs += 1
+        else:
+            self.num_files += 1
+        self._credit(subpath, size)
+        return is_dir
+
+    def _add_tree(self, subpath, stats):
+        if self._add(subpath, stats):
+            path = self._path(subpath)
+            for sub_path, sub_stats in walk2(
+                    path, self.follow_links, self.follow_mounts,
+                    self.allow_special, self.allow_hidden,
+                    name_filter=self.name_filter):
+                self._add(
+                    os.path.join(subpath, self._subpath(sub_path, path)),
+                    sub_stats)
+
+    def _remove(self, subpath):
+        removed = []
+        subpaths = [subpath]
+        while subpaths:
+            removed.append(subpaths.pop())
+            if removed[-1] in self._children:
+                subpaths.extend(
+                    os.path.join(removed[-1], name)
+                    for name in self._children[removed[-1]])
+        for subpath in removed:
+            self._credit(subpath, -self._sizes.pop(subpath))
+            if subpath in self._children:
+                del self._children[subpath]
+                del self._devs[subpath]
+                self._unwatch(subpath)
+                self.num_dirs -= 1
+            else:
+                self.num_files -= 1
+        for subpath in removed:
+            self._totals.pop(subpath, None)
+        self._children[os.path.dirname(removed[0])].discard(
+            os.path.basename(removed[0]))
+
+    def scan(self):
+        """
+        Scan the directory and start watching it.
+
+        Returns:
+            None
+        """
+        stats = os.stat(self.base)
+        self.total_size = _get_size(stats, self.allocated)
+        self.num_files, self.num_dirs = 0, 1
+        self._children[''] = set()
+        self._devs[''] = stats.st_dev
+        self._watch('', stats)
+        for path, stats in walk2(
+                self.base, self.follow_links, self.follow_mounts,
+                self.allow_special, self.allow_hidden,
+                name_filter=self.name_filter):
+            self._add(self._subpath(path, self.base), stats)
+
+    def refresh(self, subpath):
+        """
+        Update the disk usage after an entry changed.
+
+        Args:
+            subpath (str): the entry, relative to the base directory
+
+        Returns:
+            None
+        """
+        if os.path.dirname(subpath) not in self._children:
+            return
+        stats = self._stat(subpath)
+        old_size = self._sizes.get(subpath)
+        if stats is None:
+            if old_size is not None:
+                self._remove(subpath)
+        elif old_size is None:
+            self._add_tree(subpath, stats)
+        elif stat.S_ISDIR(stats.st_mode) != (subpath in self._children):
+            self._remove(subpath)
+            self._add_tree(subpath, stats)
+        else:
+            size = _get_size(stats, self.allocated)
+            if size != old_size:
+                self._sizes[subpath] = size
+                self._credit(subpath, size - old_size)
+
+    def rescan(self, subpath):
+        """
+        Update the disk usage after a directory changed.
+
+        The sub-directories are not scanned again.
+
+        Args:
+            subpath (str): the directory, relative to the base directory
+
+        Returns:
+            None
+        """
+        if subpath not in self._children:
+            return
+        try:
+            names = set(os.listdir(self._path(subpath)))
+        except OSError:
+            names = set()
+        for name in names | self._children[subpath]:
+            self.refresh(os.path.join(subpath, name))
+
+    def update(self, timeout):
+        """
+        Wait for changes and update the disk usage accordingly.
+
+        Args:
+            timeout (float): time to wait for changes in seconds
+
+        Returns:
+            num_changes (int): number of changed entries or directories
+        """
+        end_time = time.monotonic() + timeout
+        changed, changed_dirs = set(), set()
+        if self._inotify is not None:
+            timeout = end_time - time.monotonic()
+            while timeout > 0:
+                for wd, mask, name in self._inotify.read(timeout):
+                    if mask & INOTIFY_Q_OVERFLOW:
+                        changed_dirs.update(self._children)
+                    subpath = self._subpaths.get(wd)
+                    if subpath is None:
+                        continue
+                    if mask & INOTIFY_IGNORED:
+                        if self._wds.get(subpath) == wd:
+                            del self._wds[subpath]
+                        del self._subpaths[wd]
+                    elif name:
+                        changed.add(os.path.join(subpath, name))
+                timeout = end_time - time.monotonic()
+        else:
+            time.sleep(timeout)
+        for subpath, mtime in list(self._mtimes.items()):
+            try:
+                if os.stat(self._path(subpath)).st_mtime_ns != mtime:
+                    changed_dirs.add(subpath)
+            except OSError:
+                pass
+        # parents first, so that the contents of new directories are
+        # scanned only once
+        for subpath in sorted(changed, key=len):
+            self.refresh(subpath)
+        for subpath in changed_dirs:
+            if subpath in self._mtimes:
+                try:
+                    self._mtimes[subpath] = \
+                        os.stat(self._path(subpath)).st_mtime_ns
+                except OSError:
+                    pass
+            self.rescan(subpath)
+        return len(changed) + len(changed_dirs)
+
+    def items(self):
+        """
+        Get the sizes of the displayed items.
+
+        Returns:
+            items (dict): dictionary where the key is the subfolder, relative
+                (directories end with the path separator) and the value is the
+                size. See `disk_usage()` for more details.
+        """
+        return {
+            name + os.path.sep if name in self._children else name: size
+            for name, size in self._totals.items()
+            if not self.only_dir or name in self._children}
+
+    def close(self):
+        """
+        Stop watching.
+
+        Returns:
+            None
+        """
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._wds.clear()
+        self._subpaths.clear()
+
+
+# ======================================================================
+def progress_bar(
+        factor,
+        size=16,
+        fill='=',
+        empty=' ',
+        pre='[',
+        post=']'):
+    """
+    Generate a text progress bar.
+
+    Args:
+        factor (float): Fill factor. Must be in the [0, 1] range
+        size (int): Size of the bar in characters (without pre/post decorators)
+        fill (str): String used for filled bar (repeated)
+        empty (str): String used for empty bar (repeated)
+        pre (str): String prefix of the fill bar
+        post (str): String postfix of the fill bar
+
+    Returns:
+        text (str): The fill bar.
+    """
+    if factor > 1.0:
+        factor = 1.0
+    fill_size = int(round(factor * size))
+    # empty_size = int(round((1.0 - factor) * size))
+    text = (fill * (size // len(fill) + 1))[0:fill_size] + \
+           (empty * (size // len(empty) + 1))[fill_size:size]
+    text = (pre if pre else '') + text + (post if post else '')
+    return text
+
+
+# ======================================================================
+def _adjust_format(value, order):
+    if order == 0:
+        return _SIZE_FORMATS[-1](value)
+    # the precision only depends on the number of digits of the integral part
+    return _SIZE_FORMATS[bisect.bisect_right(_SIZE_THRESHOLDS, value)](value)
+
+
+# ======================================================================
+def _to_units(o, units_prefix=UNITS_PREFIX):
+    prefix_str = ''.join(units_prefix)
+    return prefix_str[o - 1] if o > 0 else 'B'
+
+
+# ======================================================================
+@functools.lru_cache(maxsize=None)
+def _humanizer(units):
+    """
+    Build a function converting sizes to the specified units.
+
+    The units are parsed only once and the divisors and the units strings of
+    each order of magnitude are precomputed.
+
+    Args:
+        units (str): Units to be used.
+            See `humanize()` for more details.
+
+    Returns:
+        result (callable): function taking the size in bytes and returning
+            the size string and the units string
+    """
+    if _EXPLICIT_UNITS_RE.match(units):
+        order = ''.join(UNITS_PREFIX).upper().index(units[0].upper()) + 1
+        iec_units = len(units) == 1 or 3 >= len(units) > 1 and units[1] == 'i'
+        base, exp = (2, 10) if iec_units else (10, 3)
+        divisor = (base ** exp) ** order
+
+        def _humanize(size):
+            return _adjust_format(size / divisor, order), units
+
+    else:
+        if units.lower() in 'unix':
+            base, exp = 2, 10
+            units_strs = [_to_units(o).upper() for o in range(NUM_ORDERS)]
+        elif units.lower() == 'iec':
+            base, exp = 2, 10
+            units_strs = [
+                _to_units(o).upper() + ('iB' if o > 0 else '')
+                for o in range(NUM_ORDERS)]
+        elif units.lower() == 'si':
+            base, exp = 10, 3
+            units_strs = [
+                _to_units(o) + ('B' if o > 0 else '')
+                for o in range(NUM_ORDERS)]
+        else:
+            return lambda size: (str(size), 'B')
+        divisors = [(base ** exp) ** o for o in range(NUM_ORDERS)]
+        log_base = math.log(base)
+
+        def _humanize(size):
+            order = int(round(math.log(size) / log_base // exp)) \
+                if size > 0 else 0
+            return (
+                _adjust_format(size / divisors[order], order),
+                units_strs[order])
+
+    return _humanize
+
+
+# ======================================================================
+def humanize(
+        size,
+        units='iec'):
+    """
+    Human-readable file size.
+
+    Args:
+        size (int): Size in bites.
+        units (str): Units to be used.
+            Implicit options:
+                - 'iec': Use IEC units, multiples of 2^10=1024 (e.g. KiB, MiB)
+                - 'si': Use SI units, multiples of 10^3=1000 (e.g. kB, MB)
+                - 'unix': IEC units with short names (e.g. K instead of KiB)
+            Explicit options: any SI, IEC or UNIX units (case sensitive!).
+            If invalid string, falls back to none.
+
+    Returns:
+        size_str (str): Size in the new units
+        units_str (str): Units of the new size
+    """
+    return _humanizer(units)(size)
+
+
+# ======================================================================
+def _row_format(bar_size, percent_precision, len_units, fill='=', sign=''):
+    """
+    Build all the possible progress bars and the format of a usage row.
+
+    Args:
+        bar_size (int): number of characters of the progress bar
+        percent_precision (int): Number of decimal digits for percentage
+        len_units (int): number of characters reserved for the units
+        fill (str): String used for filled bar (repeated)
+        sign (str): sign option of the percentage ['' | '+']
+
+    Returns:
+        result (tuple): the tuple
+            contains:
+             - bars (list[str]): the bars for each number of filled chars
+             - line_format (callable): format taking the bar, the
+               percentage, the size string, the units string and the name
+    """
+    bars = [progress_bar(i / bar_size, bar_size, fill) for i in
+            range(bar_size + 1)] if bar_size > 0 else ['']
+    len_sign = len(sign)
+    line_format = '{{}} {{:>{}{}.{}%}} {{:>{}}}{{:<{}}} {{}}'.format(
+        sign, len_sign + 3 + 1 + 1 + percent_precision, percent_precision,
+        len_sign + MAX_CHAR_SIZE, len_units).format
+    return bars, line_format
+
+
+# ======================================================================
+def _disk_usage_lines(
+        contents,
+        total_size,
+        num_files,
+        num_dirs,
+        base_path,
+        sort_by='name',
+        units='unix',
+        percent_precision=2,
+        bar_size=24,
+        verbose=D_VERB_LVL,
+        scan_stats=None,
+        estimate=None):
+    """
+    Generate the lines of the human-readable disk usage info.
+
+    See `disk_usage_to_str()` for the meaning of the arguments.
+
+    Yields:
+        line (str): the next line (without line separator)
+    """
+    if scan_stats is not None:
+        scan_stats.begin('render')
+    to_units = _humanizer(units)
+    tot_size_str, tot_units_str = to_units(total_size)
+    # assuming the length of the units str is monotonically increasing
+    len_units = len(tot_units_str) + 1
+    is_sampled = estimate is not None and estimate.fraction < 1.0
+    if verbose >= D_VERB_LVL:
+        if sort_by.startswith('name'):
+            index = 0
+        elif sort_by.startswith('size'):
+            index = 1
+        else:
+            index = 0
+            msg = '{}: unknown sorting. Fall back to: name'.format(sort_by)
+            warnings.warn(msg)
+        reverse = sort_by.endswith('_r')
+        # use the name to break ties, so that the output does not depend
+        # on the order in which the items were found
+        sorted_items = sorted(
+            contents.items(), key=lambda x: (x[index], x[0]),
+            reverse=reverse)
+        # all the possible bars and the row format are computed only once
+        bars, line_format = _row_format(
+            bar_size, percent_precision, len_units)
+        interval_format = '\u00b1{{:>{}}}{{:<{}}}'.format(
+            MAX_CHAR_SIZE, len_units).format
+        for name, size in sorted_items:
+            percent = size / total_size if total_size != 0.0 else 0.0
+            size_str, units_str = to_units(size)
+            if is_sampled:
+                # show the confidence interval before the name
+                name = interval_format(
+                    *to_units(int(round(estimate.interval(name))))) + name
+            yield line_format(
+                bars[int(round(min(percent, 1.0) * bar_size))],
+                percent, size_str, units_str, name)
+    yield os.path.realpath(base_path)
+    if is_sampled:
+        interval_str, interval_units_str = to_units(
+            int(round(estimate.interval())))
+        yield '~{}{} ({}B) \u00b1{}{} ({:.0%} confidence, {:.1%} sampled), ' \
+            '~{} file(s), ~{} dir(s)'.format(
+                tot_size_str, tot_units_str, total_size,
+                interval_str.strip(), interval_units_str,
+                estimate.confidence, estimate.fraction, num_files, num_dirs)
+    else:
+        yield '{}{} ({}B), {} file(s), {} dir(s)'.format(
+            tot_size_str, tot_units_str, total_size, num_files, num_dirs)
+    if estimate is not None and not estimate.is_complete:
+        yield 'W: incomplete results (deadline reached)'
+    if scan_stats is not None:
+        scan_stats.end('render')
+
+
+# ======================================================================
+def _aggregation_lines(
+        aggregator,
+        units='unix',
+        percent_precision=2,
+        bar_size=24):
+    """
+    Generate the lines of the human-readable aggregation.
+
+    Args:
+        aggregator (UsageAggregator): the aggregation (after the scan)
+        units (str): units of the sizes. See `humanize()`.
+        percent_precision (int): the number of decimal places of percentages
+        bar_size (int): the size of the usage bar in characters
+
+    Yields:
+        line (str): the next line (without line separator)
+    """
+    to_units = _humanizer(units)
+    total_size = sum(aggregator.sizes.values())
+    len_units = len(to_units(total_size)[1]) + 1
+    len_count = len(str(max(aggregator.counts.values(), default=0)))
+    bars = [progress_bar(i / bar_size, bar_size) for i in
+            range(bar_size + 1)] if bar_size > 0 else ['']
+    line_format = '{{}} {{:>{}.{}%}} {{:>{}}}{{:<{}}} {{:>{}}} {{}}'.format(
+        3 + 1 + 1 + percent_precision, percent_precision,
+        MAX_CHAR_SIZE, len_units, len_count).format
+    yield '{}:'.format(aggregator.title)
+    for key in aggregator.items():
+        size = aggregator.sizes[key]
+        percent = size / total_size if total_size != 0.0 else 0.0
+        yield line_format(
+            bars[int(round(min(percent, 1.0) * bar_size))]
+            if bar_size > 0 else '',
+            percent, *to_units(size), aggregator.counts[key],
+            aggregator.label(key, units))
+
+
+# ======================================================================
+def disk_usage_to_str(
+        contents,
+        total_size,
+        num_files,
+        num_dirs,
+        base_path,
+        sort_by='name',
+        units='unix',
+        percent_precision=2,
+        bar_size=24,
+        line_sep='\n',
+        verbose=D_VERB_LVL,
+        scan_stats=None,
+        estimate=None):
+    """
+    Convert to human-readable text the previously calculate disk usage info.
+
+    Args:
+        contents (dict): dictionary where the key is the subfolder, relative
+        total_size (int): total size of sub-files and sub-directories in bytes
+        num_files (int): total number of files
+        num_dirs (int): total number of dirs
+        base_path (str): directory where to operate
+        sort_by (str): specify how to sort the results
+            ['name'|'name_r'|'size'|'size_r']
+        units (str): units to use ['iec'|'si'|'unix'|<exact>] (e.g. 'KiB').
+            See 'humanize' for more details
+        percent_precision (int): Number of decimal digits for percentage
+        bar_size (int): number of characters of the progress bar
+        line_sep (str): line separator
+        verbose (int): set the level of verbosity
+        scan_stats (ScanStats|None): collector of scan statistics
+        estimate (UsageEstimate|None): the accuracy of the disk usage info.
+            If the sizes were sampled, their confidence intervals are shown.
+            If the results are incomplete, they are marked as such.
+
+    Returns:
+        text (str): String containing the disk usage information
+    """
+    return line_sep.join(_disk_usage_lines(
+        contents, total_size, num_files, num_dirs, base_path, sort_by, units,
+        percent_precision, bar_size, verbose, scan_stats, estimate))
+
+
+# ======================================================================
+def write_lines(
+        file,
+        lines,
+        line_sep='\n',
+        batch_size=4096):
+    """
+    Write lines to a file incrementally.
+
+    The lines are joined and written in batches, so that neither the whole
+    text is built in memory nor each line results in a separate write.
+
+    Args:
+        file (file): the file object to write to
+        lines (Iterable[str]): the lines to write (without line separator)
+        line_sep (str): line separator (not written after the last line)
+        batch_size (int): number of lines written at once
+
+    Returns:
+        None
+    """
+    batch = []
+    sep = ''
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            file.write(sep + line_sep.join(batch))
+            batch.clear()
+            sep = line_sep
+    if batch:
+        file.write(sep + line_sep.join(batch))
+
+
+# ======================================================================
+def diff_usage(
+        old_contents,
+        contents):
+    """
+    Compute the size differences between the results of two scans.
+
+    Uses a hashed join over the paths, i.e. O(n) time.
+
+    Args:
+        old_contents (Mapping): the items of the older scan.
+            See `disk_usage()` for more details.
+        contents (Mapping): the items of the newer scan.
+            See `disk_usage()` for more details.
+
+    Returns:
+        deltas (dict): dictionary where the key is the subfolder, relative
+            and the value is the (non-zero) size difference in bytes
+    """
+    deltas = {name: -size for name, size in old_contents.items()}
+    for name, size in contents.items():
+        deltas[name] = deltas.get(name, 0) + size
+    return {name: delta for name, delta in deltas.items() if delta}
+
+
+# ======================================================================
+def merge_usage(results):
+    """
+    Merge the results of the scans of disjoint parts of a tree.
+
+    The merge is associative and commutative, therefore partial results
+    (e.g. of the shards of a tree, see `disk_usage()`) can be merged in any
+    order and grouping, even if already merged.
+
+    Args:
+        results (Iterable[tuple]): the (items, total_size, num_files,
+            num_dirs) of each scan. See `disk_usage()` for more details.
+
+    Returns:
+        items (dict): the merged items
+        total_size (int): total size of sub-files and sub-directories in bytes
+        num_files (int): total number of files
+        num_dirs (int): total number of dirs
+    """
+    items = {}
+    total_size, num_files, num_dirs = 0, 0, 0
+    for contents, size, files, dirs in results:
+        for name, value in contents.items():
+            items[name] = items.get(name, 0) + value
+        total_size += size
+        num_files += files
+        num_dirs += dirs
+    return items, total_size, num_files, num_dirs
+
+
+# ======================================================================
+def write_usage(file, base, result, shard=None):
+    """
+    Write the (partial) results of a scan as JSON.
+
+    Args:
+        file (file): the file object where to write
+        base (str): the scanned directory
+        result (tuple): the (items, total_size, num_files, num_dirs), as
+            returned by `disk_usage()`
+        shard (tuple[int]|None): the index of the shard and the number of
+            shards (if the scan was sharded)
+
+    Returns:
+        None
+    """
+    contents, total_size, num_files, num_dirs = result
+    json.dump(
+        dict(
+            hdu=__version__, base=os.path.realpath(base),
+            shard=list(shard) if shard is not None else None,
+            items=dict(contents.items()), total_size=total_size,
+            num_files=num_files, num_dirs=num_dirs),
+        file, separators=(',', ':'))
+
+
+# ======================================================================
+def read_usage(filepath):
+    """
+    Read the (partial) results of a scan, as written by `write_usage()`.
+
+    Args:
+        filepath (str): the path to the file (optionally compressed, see
+            `SnapshotWriter`)
+
+    Returns:
+        base (str): the scanned directory
+        shard (tuple[int]|None): the index of the shard and the number of
+            shards (if the scan was sharded)
+        result (tuple): the (items, total_size, num_files, num_dirs)
+    """
+    with _open_snapshot(filepath) as file:
+        data = json.load(file)
+    shard = tuple(data['shard']) if data.get('shard') is not None else None
+    return data['base'], shard, (
+        data['items'], data['total_size'], data['num_files'],
+        data['num_dirs'])
+
+
+# ======================================================================
+def _signed_humanize(size, to_units):
+    size_str, units_str = to_units(abs(size))
+    return ('-' if size < 0 else '+') + size_str.strip(), units_str
+
+
+# ======================================================================
+def disk_usage_diff_to_str(
+        deltas,
+        old_total_size,
+        total_size,
+        old_num_files,
+        num_files,
+        old_num_dirs,
+        num_dirs,
+        base_path,
+        sort_by='size',
+        units='unix',
+        percent_precision=2,
+        bar_size=24,
+        line_sep='\n',
+        verbose=D_VERB_LVL):
+    """
+    Convert to human-readable text the differences between two scans.
+
+    The percentages are relative to the total size of the older scan, while
+    the progress bars are relative to the largest difference.
+
+    Args:
+        deltas (dict): dictionary where the key is the subfolder, relative
+            and the value is the size difference in bytes
+        old_total_size (int): total size of the older scan in bytes
+        total_size (int): total size of the newer scan in bytes
+        old_num_files (int): total number of files of the older scan
+        num_files (int): total number of files of the newer scan
+        old_num_dirs (int): total number of dirs of the older scan
+        num_dirs (int): total number of dirs of the newer scan
+        base_path (str): directory where to operate
+        sort_by (str): specify how to sort the results
+            ['name'|'name_r'|'size'|'size_r'], where 'size' sorts by the
+            size difference, i.e. largest growth last
+        units (str): units to use ['iec'|'si'|'unix'|<exact>] (e.g. 'KiB').
+            See 'humanize' for more details
+        percent_precision (int): Number of decimal digits for percentage
+        bar_size (int): number of characters of the progress bar
+        line_sep (str): line separator
+        verbose (int): set the level of verbosity
+
+    Returns:
+        text (str): String containing the disk usage differences
+    """
+    lines = []
+    to_units = _humanizer(units)
+    if verbose >= D_VERB_LVL and deltas:
+        if sort_by.startswith('name'):
+            index = 0
+        elif sort_by.startswith('size'):
+            index = 1
+        else:
+            index = 0
+            msg = '{}: unknown sorting. Fall back to: name'.format(sort_by)
+            warnings.warn(msg)
+        reverse = sort_by.endswith('_r')
+        sorted_items = sorted(
+            list(deltas.items()), key=lambda x: (x[index], x[0]),
+            reverse=reverse)
+        max_delta = max(abs(delta) for delta in deltas.values())
+        len_units = max(
+            len(to_units(abs(delta))[1]) for delta in deltas.values()) + 1
+        # the growths and the shrinkages use different bar fills
+        growth_bars, line_format = _row_format(
+            bar_size, percent_precision, len_units, '+', '+')
+        shrink_bars, line_format = _row_format(
+            bar_size, percent_precision, len_units, '-', '+')
+        for name, delta in sorted_items:
+            percent = delta / old_total_size if old_total_size else 0.0
+            size_str, units_str = _signed_humanize(delta, to_units)
+            bars = growth_bars if delta > 0 else shrink_bars
+            lines.append(line_format(
+                bars[int(round(abs(delta) / max_delta * bar_size))],
+                percent, size_str, units_str, name))
+    lines.append(os.path.realpath(base_path))
+    old_size_str, old_units_str = to_units(old_total_size)
+    size_str, units_str = to_units(total_size)
+    delta_str, delta_units_str = _signed_humanize(
+        total_size - old_total_size, to_units)
+    lines.append(
+        '{}{} -> {}{}: {}{} ({:+}B), {:+} file(s), {:+} dir(s)'.format(
+            old_size_str, old_units_str, size_str, units_str,
+            delta_str, delta_units_str, total_size - old_total_size,
+            num_files - old_num_files, num_dirs - old_num_dirs))
+    text = line_sep.join(lines)
+    return text
+
+
+# ======================================================================
+def _hdu_target(
+        base,
+        follow_links,
+        follow_mounts,
+        allow_special,
+        allow_hidden,
+        only_dir,
+        max_depth,
+        sort_by,
+        units,
+        percent_precision,
+        bar_size,
+        eof_line_sep,
+        verbose,
+        workers,
+        cache_path,
+        cache_clear,
+        cache_max,
+        dedup_links,
+        allocated,
+        progress,
+        stream,
+        top,
+        export_path,
+        from_snapshot,
+        diff_path,
+        show_stats,
+        sample,
+        deadline,
+        max_fds,
+        patterns,
+        group_by,
+        throttle,
+        nested=()):
+    """
+    Compute the human-friendly summary of disk usage for a single target.
+
+    See `hdu()` for the meaning of the arguments.
+    The reports of the `nested` directories that are reached during the scan
+    are also computed (see `NestedUsage`).
+
+    Returns:
+        lines (Iterable[str]|None): the lines to display (if any).
+            The lines of a directory report are generated lazily.
+        is_dir (bool): True if the target is a directory
+    """
+    # deal with unicode input
+    try:
+        base = base.encode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    finally:
+        base = base.decode('utf-8')
+
+    line_sep = '\0' if eof_line_sep else '\n'
+    is_snapshot = from_snapshot and os.path.isfile(base)
+    if is_snapshot or not from_snapshot and os.path.isdir(base):
+        if is_snapshot:
+            base, base_stats, paths = read_snapshot(base)
+            source = base_stats, paths
+        else:
+            source = None
+        cache = ScanCache(cache_path, cache_max, cache_clear) \
+            if cache_path else None
+        scan_progress = ScanProgress(units=units) if progress else None
+        export = SnapshotWriter(export_path) if export_path else None
+        scan_stats = ScanStats() if show_stats else None
+        estimate = UsageEstimate()
+        name_filter = NameFilter(*patterns) if any(patterns) else None
+        aggregators = [AGGREGATORS[name]() for name in group_by]
+        scan_throttle = ScanThrottle(*throttle) if throttle[0] > 0 else None
+
+        def on_item(name, size):
+            if scan_progress is not None:
+                scan_progress.close()
+            size_str, units_str = humanize(size, units)
+            print(
+                '{:>{len_size}}{} {}'.format(
+                    size_str, units_str, name, len_size=MAX_CHAR_SIZE),
+                file=sys.stderr)
+
+        if diff_path:
+            # read the old snapshot first, so that problems show up early
+            old_base, old_base_stats, old_paths = read_snapshot(diff_path)
+            old_contents, old_total, old_num_files, old_num_dirs = disk_usage(
+                old_base, only_dir=only_dir, max_depth=max_depth,
+                verbose=verbose, dedup_links=dedup_links,
+                allocated=allocated, source=(old_base_stats, old_paths),
+                name_filter=NameFilter(*patterns) if any(patterns) else None)
+        try:
+            contents, total, num_files, num_dirs = disk_usage(
+                base, follow_links, follow_mounts, allow_special,
+                allow_hidden, only_dir, max_depth, verbose, workers, cache,
+                dedup_links, allocated, scan_progress,
+                on_item if stream else None, 0 if diff_path else top,
+                source, export, scan_stats, sample, deadline, estimate,
+                max_fds, name_filter, nested, aggregators, None,
+                scan_throttle)
+        finally:
+            if cache is not None:
+                cache.close()
+            if export is not None:
+                export.close()
+            if scan_progress is not None:
+                scan_progress.close()
+        if diff_path:
+            deltas = diff_usage(old_contents, contents)
+            if top > 0:
+                deltas = dict(heapq.nlargest(
+                    top, deltas.items(), key=lambda x: x[1]))
+            lines = [disk_usage_diff_to_str(
+                deltas, old_total, total, old_num_files, num_files,
+                old_num_dirs, num_dirs, base, sort_by, units,
+                percent_precision, bar_size, line_sep, verbose)]
+            if not estimate.is_complete or not old_paths.is_complete:
+                lines.append('W: incomplete results (deadline reached)')
+        else:
+            lines = _disk_usage_lines(
+                contents, total, num_files, num_dirs, base, sort_by, units,
+                percent_precision, bar_size, verbose, scan_stats, estimate)
+            for nested_usage in nested:
+                if nested_usage.is_found:
+                    nested_usage.lines = _disk_usage_lines(
+                        *nested_usage.result(), nested_usage.base, sort_by,
+                        units, percent_precision, bar_size, verbose)
+        if aggregators:
+            def with_aggregations(lines):
+                yield from lines
+                for aggregator in aggregators:
+                    yield ''
+                    yield from _aggregation_lines(
+                        aggregator, units, percent_precision, bar_size)
+
+            lines = with_aggregations(lines)
+        if scan_stats is not None:
+            def with_stats(lines):
+                yield from lines
+                print(scan_stats.to_str(), file=sys.stderr)
+
+            lines = with_stats(lines)
+        return lines, True
+    elif not from_snapshot and os.path.isfile(base):
+        size = _get_size(os.stat(base), allocated)
+        contents = {base: size}
+        lines = _disk_usage_lines(
+            contents, size, 1, 0, base, sort_by, units,
+            percent_precision, bar_size, verbose)
+        return lines, False
+    else:
+        if verbose >= VERB_LVL['low']:
+            return ['W: file not found: {}'.format(base)], False
+        else:
+            return None, False
+
+
+# ======================================================================
+def _hdu_shared_targets(
+        base_paths,
+        target_args,
+        max_depth,
+        top,
+        workers):
+    """
+    Compute the summary of disk usage of the targets, sharing the scans.
+
+    Each target nested in another target (after resolving the paths) is
+    computed during the scan of the outermost target containing it,
+    whenever it is reached.
+
+    Args:
+        base_paths (list[str]): List of paths to analyze
+        target_args (tuple): the other arguments of `_hdu_target()`
+        max_depth (int): max recursion depth (negative for unlimited)
+        top (int): only show the largest items up to this number (0 for all)
+        workers (int): number of threads used for scanning directories
+
+    Yields:
+        lines (Iterable[str]|None): the lines to display (if any)
+        is_dir (bool): True if the target is a directory
+    """
+    real_paths = [
+        os.path.realpath(base) if os.path.isdir(base) else None
+        for base in base_paths]
+    # the index of the outermost target containing each target
+    outers = list(range(len(base_paths)))
+    for i, real_path in enumerate(real_paths):
+        for j, other in enumerate(real_paths):
+            if real_path is None or other is None or i == j:
+                continue
+            is_inner = real_path.startswith(other.rstrip(os.path.sep)
+                                            + os.path.sep) \
+                or real_path == other and j < i
+            outer = real_paths[outers[i]]
+            if is_inner and (len(other) < len(outer)
+                             or len(other) == len(outer) and j < outers[i]):
+                outers[i] = j
+    results = {}
+    done = set()
+    for i, base in enumerate(base_paths):
+        if i not in results and outers[i] not in done \
+                and outers.count(outers[i]) > 1:
+            # compute the outer target together with the nested ones
+            j = outers[i]
+            done.add(j)
+            nested = {
+                k: NestedUsage(
+                    os.path.relpath(real_paths[k], real_paths[j])
+                    if real_paths[k] != real_paths[j] else '',
+                    max_depth, top, workers, base_paths[k])
+                for k in range(len(base_paths))
+                if k != j and outers[k] == j and k not in results}
+            results[j] = _hdu_target(
+                base_paths[j], *target_args, nested=list(nested.values()))
+            for k, nested_usage in nested.items():
+                if nested_usage.lines is not None:
+                    results[k] = nested_usage.lines, True
+        if i in results:
+            yield results.pop(i)
+        else:
+            yield _hdu_target(base, *target_args)
+
+
+# ======================================================================
+def _hdu_target_list(base, *target_args):
+    """
+    Compute the human-friendly summary of disk usage for a single target.
+
+    Same as `_hdu_target()`, except that the lines are returned as a list,
+    so that the result can be sent across processes.
+    """
+    lines, is_dir = _hdu_target(base, *target_args)
+    return list(lines) if lines is not None else None, is_dir
+
+
+# ======================================================================
+def _shard_usage(
+        base,
+        shard,
+        follow_links,
+        follow_mounts,
+        allow_special,
+        allow_hidden,
+        only_dir,
+        max_depth,
+        verbose,
+        workers,
+        dedup_links,
+        allocated,
+        max_fds,
+        patterns,
+        throttle):
+    """
+    Compute the disk usage of a shard of a single target.
+
+    See `hdu()` for the meaning of the arguments.
+
+    Returns:
+        result (tuple): the (items, total_size, num_files, num_dirs), like
+            `disk_usage()`, except that the items are a dictionary, so that
+            the result can be sent across processes
+    """
+    name_filter = NameFilter(*patterns) if any(patterns) else None
+    scan_throttle = ScanThrottle(*throttle) if throttle[0] > 0 else None
+    # the messages would be mixed with the results
+    contents, total, num_files, num_dirs = disk_usage(
+        base, follow_links, follow_mounts, allow_special, allow_hidden,
+        only_dir, max_depth, min(verbose, D_VERB_LVL), workers,
+        dedup_links=dedup_links, allocated=allocated, max_fds=max_fds,
+        name_filter=name_filter, shard=shard, throttle=scan_throttle)
+    return dict(contents.items()), total, num_files, num_dirs
+
+
+# ======================================================================
+def _hdu_sharded(
+        base,
+        executor,
+        num_shards,
+        shard_args,
+        sort_by,
+        units,
+        percent_precision,
+        bar_size,
+        verbose,
+        top):
+    """
+    Compute the human-friendly summary of disk usage for a single target.
+
+    The target is split into shards, scanned concurrently by the executor
+    and merged (see `merge_usage()`).
+    See `hdu()` for the meaning of the arguments.
+
+    Returns:
+        lines (Iterable[str]): the lines to display
+        is_dir (bool): True if the target is a directory
+    """
+    futures = [
+        executor.submit(_shard_usage, base, (i, num_shards), *shard_args)
+        for i in range(num_shards)]
+    contents, total, num_files, num_dirs = merge_usage(
+        future.result() for future in futures)
+    if top > 0:
+        contents = dict(heapq.nlargest(
+            top, contents.items(), key=lambda x: x[1]))
+    lines = _disk_usage_lines(
+        contents, total, num_files, num_dirs, base, sort_by, units,
+        percent_precision, bar_size, verbose)
+    return lines, True
+
+
+# ======================================================================
+def _hdu_watch(
+        base,
+        follow_links,
+        follow_mounts,
+        allow_special,
+        allow_hidden,
+        only_dir,
+        max_depth,
+        sort_by,
+        units,
+        percent_precision,
+        bar_size,
+        eof_line_sep,
+        verbose,
+        allocated,
+        interval,
+        patterns):
     """
-    Display a human-friendly summary of disk usage.
+    Show the human-friendly summary of disk usage as it changes.
 
-    Args:
-        base (str): directory where to operate
-        follow_links (bool): follow links during recursion
-        follow_mounts (bool): follow mount points during recursion
-        allow_special (bool): include special files
-        allow_hidden (bool): include hidden files
-        only_dir (bool): show only directories and not files
-        max_depth (int): max recursion depth (negative for unlimited)
-        verbose (int): set the level of verbosity
+    See `hdu()` for the meaning of the arguments.
 
     Returns:
-        items (dict): dictionary where the key is the subfolder, relative
-        total_size (int): total size of sub-files and sub-directories in bytes
+        None
     """
-    items = {}
-    dir_items = {}
-    total_size = os.path.getsize(base)
-    num_files, num_dirs = 0, 1
-    paths = walk2(
-        base, follow_links, follow_mounts, allow_special, allow_hidden)
-    if base.endswith(os.path.sep):
-        base = base[:-len(os.path.sep)]
-    base_depth = base.count(os.path.sep)
-    for path, stats in paths:
-        size = stats.st_size
-        if verbose >= VERB_LVL['debug']:
-            print(size, path)
-        subpath = path[len(base) + len(os.path.sep):]
-        depth = path.count(os.path.sep) - base_depth - 1
-        is_dir = os.path.isdir(path)
-        is_displayed = \
-            ((not only_dir) or only_dir and is_dir)
-        if (max_depth < 0 or depth < max_depth) and is_displayed:
-            name = path[len(base) + len(os.path.sep):]
-            if is_dir:
-                dir_items[name] = size
-            else:
-                items[name] = size
-        else:
-            for key in dir_items.keys():
-                if key.endswith(os.path.sep):
-                    key_str = key[:-len(os.path.sep)]
-                else:
-                    key_str = key
-                if subpath.startswith(key_str):
-                    dir_items[key] += size
-                    break
-        total_size += size
-        if is_dir:
-            num_dirs += 1
-        else:
-            num_files += 1
-    items.update({k + os.path.sep: v for k, v in dir_items.items()})
-    return items, total_size, num_files, num_dirs
+    watch = UsageWatch(
+        base, follow_links, follow_mounts, allow_special, allow_hidden,
+        only_dir, max_depth, allocated,
+        NameFilter(*patterns) if any(patterns) else None)
+    line_sep = '\0' if eof_line_sep else '\n'
+    # on a terminal, each report replaces the previous one
+    clear = '\033[H\033[2J' if sys.stdout.isatty() else '\n'
+    try:
+        watch.scan()
+        if watch.num_unwatched and verbose >= VERB_LVL['low']:
+            print('W: {} dir(s) not watched, rescanned when modified'.format(
+                watch.num_unwatched), file=sys.stderr)
+        sep = ''
+        while True:
+            sys.stdout.write(sep)
+            write_lines(
+                sys.stdout,
+                _disk_usage_lines(
+                    watch.items(), watch.total_size, watch.num_files,
+                    watch.num_dirs, base, sort_by, units, percent_precision,
+                    bar_size, verbose),
+                line_sep)
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+            sep = clear
+            while not watch.update(interval):
+                pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watch.close()
 
 
 # ======================================================================
-def progress_bar(
-        factor,
-        size=16,
-        fill='=',
-        empty=' ',
-        pre='[',
-        post=']'):
+class UsageBrowser(object):
     """
-    Generate a text progress bar.
+    Interactive terminal browser of a `UsageTree`.
 
-    Args:
-        factor (float): Fill factor. Must be in the [0, 1] range
-        size (int): Size of the bar in characters (without pre/post decorators)
-        fill (str): String used for filled bar (repeated)
-        empty (str): String used for empty bar (repeated)
-        pre (str): String prefix of the fill bar
-        post (str): String postfix of the fill bar
+    The tree is scanned only once, and the children of each node are
+    grouped in advance (see `UsageTree.children()`), while the children of
+    each directory are sorted only when first shown (and then kept), so
+    that navigating does not depend on the size of the tree.
+    Only the visible rows are rendered.
 
-    Returns:
-        text (str): The fill bar.
+    Keys:
+        up/down, page up/page down, home/end (or k/j): move the selection
+        enter/right (or l): open the selected directory
+        backspace/left (or h): go to the parent directory
+        n: sort by name (again to reverse)
+        s: sort by size (again to reverse)
+        u: switch units (unix, iec, si)
+        q: quit
     """
-    if factor > 1.0:
-        factor = 1.0
-    fill_size = int(round(factor * size))
-    # empty_size = int(round((1.0 - factor) * size))
-    text = (fill * (size // len(fill) + 1))[0:fill_size] + \
-           (empty * (size // len(empty) + 1))[fill_size:size]
-    text = (pre if pre else '') + text + (post if post else '')
-    return text
+    UNITS = ('unix', 'iec', 'si')
+    HELP = 'q:quit  enter:open  backspace:up  n/s:sort by name/size  u:units'
 
+    def __init__(
+            self,
+            tree,
+            base,
+            sort_by='size_r',
+            units='unix',
+            percent_precision=2,
+            bar_size=24):
+        """
+        Args:
+            tree (UsageTree): the tree, after `UsageTree.rollup()`
+            base (str): the directory of the root of the tree
+            sort_by (str): specify how to sort the results
+                ['name'|'name_r'|'size'|'size_r']
+            units (str): units to use ['iec'|'si'|'unix'|<exact>].
+                See 'humanize' for more details
+            percent_precision (int): number of decimal digits for percentage
+            bar_size (int): number of characters of the progress bar
+        """
+        self.tree = tree
+        self.base = os.path.realpath(base)
+        self.sort_by = sort_by
+        self.units = units
+        self.percent_precision = percent_precision
+        self.bar_size = bar_size
+        self.offsets, self.order = tree.children()
+        self.node = 0
+        self.cursor = 0
+        self.first = 0
+        # the (node, cursor, first) of the directories opened before
+        self._history = []
+        # the sorted children, by (node, sort_by)
+        self._sorted = {}
 
-# ======================================================================
-def _adjust_format(value, order, num_chars=MAX_CHAR_SIZE):
-    len_integral_part = len(str(int(value)))
-    if len_integral_part + 1 > num_chars or order == 0:
-        precision = 0
-    else:
-        precision = num_chars - len_integral_part - 1
-    return '{:3.{precision}f}'.format(value, precision=precision)
+    def children(self, node):
+        """
+        Get the sorted children of a node.
 
+        Args:
+            node (int): the index of the node
 
-# ======================================================================
-def _fix_size(size, base, exp):
-    order = int(round(math.log(size, base) // exp)) if size > 0 else 0
-    new_size = size / (base ** exp) ** order
-    return new_size, order
+        Returns:
+            children (list[int]): the indices of the children
+        """
+        key = node, self.sort_by
+        if key not in self._sorted:
+            if len(self._sorted) > 1024:
+                self._sorted.clear()
+            names, sizes = self.tree.names, self.tree.sizes
+            reverse = self.sort_by.endswith('_r')
+            children = sorted(
+                self.order[self.offsets[node]:self.offsets[node + 1]],
+                key=names.__getitem__, reverse=reverse)
+            if self.sort_by.startswith('size'):
+                # the sort is stable, therefore ties are sorted by name,
+                # like in `disk_usage_to_str()`
+                children.sort(key=sizes.__getitem__, reverse=reverse)
+            self._sorted[key] = children
+        return self._sorted[key]
 
+    def line(self, i, total_size, len_units):
+        """
+        Render the line of a node.
 
-# ======================================================================
-def _to_units(o, units_prefix=UNITS_PREFIX):
-    prefix_str = ''.join(units_prefix)
-    return prefix_str[o - 1] if o > 0 else 'B'
+        Args:
+            i (int): the index of the node
+            total_size (int): the size of the directory being shown
+            len_units (int): the number of characters of the units
 
+        Returns:
+            text (str): the line
+        """
+        size = self.tree.sizes[i]
+        percent = size / total_size if total_size else 0.0
+        size_str, units_str = humanize(size, self.units)
+        return ' '.join((
+            progress_bar(percent, self.bar_size) if self.bar_size > 0 else '',
+            '{:>{len_size}.{len_precision}%}'.format(
+                percent, len_size=3 + 1 + 1 + self.percent_precision,
+                len_precision=self.percent_precision),
+            '{:>{len_size}}{:<{len_units}}'.format(
+                size_str, units_str,
+                len_size=MAX_CHAR_SIZE, len_units=len_units),
+            self.tree.names[i] + (os.path.sep if self.tree.is_dir(i) else '')))
 
-# ======================================================================
-def humanize(
-        size,
-        units='iec'):
-    """
-    Human-readable file size.
+    def draw(self, screen):
+        """
+        Draw the current directory.
 
-    Args:
-        size (int): Size in bites.
-        units (str): Units to be used.
-            Implicit options:
-                - 'iec': Use IEC units, multiples of 2^10=1024 (e.g. KiB, MiB)
-                - 'si': Use SI units, multiples of 10^3=1000 (e.g. kB, MB)
-                - 'unix': IEC units with short names (e.g. K instead of KiB)
-            Explicit options: any SI, IEC or UNIX units (case sensitive!).
-            If invalid string, falls back to none.
+        Args:
+            screen (curses.window): the window
 
-    Returns:
-        size_str (str): Size in the new units
-        units_str (str): Units of the new size
-    """
-    prefix_str = ''.join(UNITS_PREFIX)
+        Returns:
+            None
+        """
+        height, width = screen.getmaxyx()
+        num_rows = max(height - 2, 1)
+        children = self.children(self.node)
+        self.cursor = max(min(self.cursor, len(children) - 1), 0)
+        if self.cursor < self.first:
+            self.first = self.cursor
+        elif self.cursor >= self.first + num_rows:
+            self.first = self.cursor - num_rows + 1
+        total_size = self.tree.sizes[self.node]
+        size_str, units_str = humanize(total_size, self.units)
+        path = os.path.join(self.base, self.tree.path(self.node))
+        screen.erase()
+        screen.addnstr(
+            0, 0, '{}{} {} ({} item(s))'.format(
+                size_str.strip(), units_str, path, len(children)),
+            width - 1, curses.A_BOLD)
+        for row, i in enumerate(
+                children[self.first:self.first + num_rows], 1):
+            screen.addnstr(
+                row, 0, self.line(i, total_size, len(units_str) + 1),
+                width - 1,
+                curses.A_REVERSE if self.first + row - 1 == self.cursor
+                else curses.A_NORMAL)
+        if height > 2:
+            screen.addnstr(
+                height - 1, 0, '{}  [sort: {}, units: {}]'.format(
+                    self.HELP, self.sort_by, self.units), width - 1)
+        screen.refresh()
 
-    # explicit units
-    if re.match('[{}]B'.format(prefix_str), units) or \
-            re.match('[{}](iB)?'.format(prefix_str.upper()), units):
-        order = prefix_str.upper().index(units[0].upper()) + 1
-        units_str = units
-        iec_units = len(units) == 1 or 3 >= len(units) > 1 and units[1] == 'i'
-        base, exp = (2, 10) if iec_units else (10, 3)
-        size_str = _adjust_format(size / (base ** exp) ** order, order)
-    # set units class
-    else:
-        if units.lower() in 'unix':
-            new_size, order = _fix_size(size, 2, 10)
-            size_str = _adjust_format(new_size, order)
-            units_str = _to_units(order).upper()
-        elif units.lower() == 'iec':
-            new_size, order = _fix_size(size, 2, 10)
-            size_str = _adjust_format(new_size, order)
-            units_str = _to_units(order).upper() + ('iB' if order > 0 else '')
-        elif units.lower() == 'si':
-            new_size, order = _fix_size(size, 10, 3)
-            size_str = _adjust_format(new_size, order)
-            units_str = _to_units(order) + ('B' if order > 0 else '')
-        else:
-            size_str = str(size)
-            units_str = 'B'
+    def handle(self, key, num_rows=20):
+        """
+        Handle a key press.
+
+        Args:
+            key (int): the key (as obtained from `curses.window.getch()`)
+            num_rows (int): the number of rows of a page
+
+        Returns:
+            result (bool): False to quit
+        """
+        children = self.children(self.node)
+        if key in (ord('q'), 27):
+            return False
+        elif key in (curses.KEY_UP, ord('k')):
+            self.cursor -= 1
+        elif key in (curses.KEY_DOWN, ord('j')):
+            self.cursor += 1
+        elif key == curses.KEY_PPAGE:
+            self.cursor -= num_rows
+        elif key == curses.KEY_NPAGE:
+            self.cursor += num_rows
+        elif key == curses.KEY_HOME:
+            self.cursor = 0
+        elif key == curses.KEY_END:
+            self.cursor = len(children) - 1
+        elif key in (curses.KEY_RIGHT, curses.KEY_ENTER, 10, 13, ord('l')):
+            if children and self.tree.is_dir(children[self.cursor]):
+                self._history.append((self.node, self.cursor, self.first))
+                self.node = children[self.cursor]
+                self.cursor = self.first = 0
+        elif key in (
+                curses.KEY_LEFT, curses.KEY_BACKSPACE, 8, 127, ord('h')):
+            if self._history:
+                self.node, self.cursor, self.first = self._history.pop()
+        elif key in (ord('n'), ord('s')):
+            sort_by = 'name' if key == ord('n') else 'size'
+            if self.sort_by.startswith(sort_by):
+                sort_by = self.sort_by[:len(sort_by)] \
+                    + ('' if self.sort_by.endswith('_r') else '_r')
+            self.sort_by = sort_by
+            self.cursor = self.first = 0
+        elif key == ord('u'):
+            self.units = self.UNITS[
+                (self.UNITS.index(self.units) + 1) % len(self.UNITS)
+                if self.units in self.UNITS else 0]
+        return True
+
+    def run(self, screen):
+        """
+        Run the browser until the user quits.
 
-    return size_str, units_str
+        Args:
+            screen (curses.window): the window (e.g. from `curses.wrapper()`)
+
+        Returns:
+            None
+        """
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        while True:
+            self.draw(screen)
+            if not self.handle(
+                    screen.getch(), max(screen.getmaxyx()[0] - 2, 1)):
+                break
 
 
 # ======================================================================
-def disk_usage_to_str(
-        contents,
-        total_size,
-        num_files,
-        num_dirs,
-        base_path,
-        sort_by='name',
-        units='unix',
-        percent_precision=2,
-        bar_size=24,
-        line_sep='\n',
-        verbose=D_VERB_LVL):
+def _hdu_browse(
+        base,
+        follow_links,
+        follow_mounts,
+        allow_special,
+        allow_hidden,
+        sort_by,
+        units,
+        percent_precision,
+        bar_size,
+        verbose,
+        workers,
+        dedup_links,
+        allocated,
+        progress,
+        max_fds,
+        patterns):
     """
-    Convert to human-readable text the previously calculate disk usage info.
+    Browse interactively the disk usage of a directory.
 
-    Args:
-        contents (dict): dictionary where the key is the subfolder, relative
-        total_size (int): total size of sub-files and sub-directories in bytes
-        num_files (int): total number of files
-        num_dirs (int): total number of dirs
-        base_path (str): directory where to operate
-        sort_by (str): specify how to sort the results
-            ['name'|'name_r'|'size'|'size_r']
-        units (str): units to use ['iec'|'si'|'unix'|<exact>] (e.g. 'KiB').
-            See 'humanize' for more details
-        percent_precision (int): Number of decimal digits for percentage
-        bar_size (int): number of characters of the progress bar
-        line_sep (str): line separator
-        verbose (int): set the level of verbosity
+    See `hdu()` for the meaning of the arguments.
 
     Returns:
-        text (str): String containing the disk usage information
+        None
     """
-    tot_size_str, tot_units_str = humanize(total_size, units)
-    # assuming the length of the units str is monotonically increasing
-    len_units = len(tot_units_str) + 1
-    lines = []
-    if verbose >= D_VERB_LVL:
-        if sort_by.startswith('name'):
-            index = 0
-        elif sort_by.startswith('size'):
-            index = 1
-        else:
-            index = 0
-            msg = '{}: unknown sorting. Fall back to: name'.format(sort_by)
-            warnings.warn(msg)
-        reverse = sort_by.endswith('_r')
-        sorted_items = sorted(
-            list(contents.items()), key=lambda x: x[index], reverse=reverse)
-        for (name, size) in sorted_items:
-            percent = size / total_size if total_size != 0.0 else 0.0
-            size_str, units_str = humanize(size, units)
-            lines.append(
-                ' '.join((
-                    progress_bar(percent, bar_size) if bar_size > 0 else '',
-                    '{:>{len_size}.{len_precision}%}'.format(
-                        percent, len_size=3 + 1 + 1 + percent_precision,
-                        len_precision=percent_precision),
-                    '{:>{len_size}}{:<{len_units}}'.format(
-                        size_str, units_str,
-                        len_size=MAX_CHAR_SIZE, len_units=len_units),
-                    name)))
-    lines.append(os.path.realpath(base_path))
-    lines.append(
-        '{}{} ({}B), {} file(s), {} dir(s)'.format(
-            tot_size_str, tot_units_str, total_size, num_files, num_dirs))
-    text = line_sep.join(lines)
-    return text
+    if curses is None:
+        print('W: interactive mode not available (no curses)')
+        return
+    if not os.path.isdir(base):
+        print('W: directory not found: {}'.format(base))
+        return
+    scan_progress = ScanProgress(units=units) if progress else None
+    try:
+        contents, total_size, _, _ = disk_usage(
+            base, follow_links, follow_mounts, allow_special, allow_hidden,
+            False, -1, verbose, workers, dedup_links=dedup_links,
+            allocated=allocated, progress=scan_progress, max_fds=max_fds,
+            name_filter=NameFilter(*patterns) if any(patterns) else None)
+    finally:
+        if scan_progress is not None:
+            scan_progress.close()
+    # like the other directories, include the size of `base` itself
+    contents.tree.sizes[0] = total_size
+    browser = UsageBrowser(
+        contents.tree, base, sort_by, units, percent_precision, bar_size)
+    try:
+        curses.wrapper(browser.run)
+    except KeyboardInterrupt:
+        pass
 
 
 # ======================================================================
@@ -393,7 +4516,37 @@ def hdu(
         percent_precision,
         bar_size,
         eof_line_sep,
-        verbose):
+        verbose,
+        workers=1,
+        target_jobs=1,
+        unordered=False,
+        cache_path=None,
+        cache_clear=False,
+        cache_max=-1,
+        dedup_links=False,
+        allocated=False,
+        progress=False,
+        stream=False,
+        top=0,
+        export_path=None,
+        from_snapshot=False,
+        diff_path=None,
+        show_stats=False,
+        sample=1.0,
+        deadline=None,
+        watch=None,
+        max_fds=0,
+        exclude=(),
+        include=(),
+        exclude_regex=(),
+        include_regex=(),
+        browse=False,
+        group_by=(),
+        shard=None,
+        num_shards=1,
+        throttle=0.0,
+        adaptive=False,
+        idle_io=False):
     """
     Human-friendly summary of disk usage.
 
@@ -413,41 +4566,229 @@ def hdu(
         bar_size (int): number of characters of the progress bar
         eof_line_sep (bool): use '\0' instead of '\n' as line separator
         verbose (int): set the level of verbosity
+        workers (int): number of threads used for scanning directories
+        target_jobs (int): max number of targets scanned concurrently.
+            If larger than 1, each target is scanned in a separate process.
+            Otherwise, targets nested in other targets are computed from
+            the scan of the outer target (when the output is not affected).
+        unordered (bool): display the results as soon as they are available
+            instead of following the order of `base_paths`.
+            Only relevant if `target_jobs` is larger than 1.
+        cache_path (str|None): path to the scan cache file.
+            If empty or None, the cache is not used.
+            See `ScanCache` for more details.
+        cache_clear (bool): remove the previous contents of the scan cache
+        cache_max (int): max number of directories in the scan cache
+            (negative for unlimited)
+        dedup_links (bool): count the size of hard-linked files only once
+        allocated (bool): use the allocated size instead of the apparent size
+        progress (bool): show the progress of the scan on stderr
+        stream (bool): show the size of each top-level item on stderr, as
+            soon as it is complete
+        top (int): only show the largest items up to this number (0 for all)
+        export_path (str|None): path where to write a snapshot of the scan.
+            Only sensible for a single target.
+            See `SnapshotWriter` for more details.
+        from_snapshot (bool): read `base_paths` as snapshot files (see
+            `read_snapshot()`), instead of scanning them
+        diff_path (str|None): path to a snapshot to compare against.
+            If specified, only the size differences from the snapshot are
+            shown (with `top`, the largest growths).
+        show_stats (bool): show the statistics of each scan on stderr.
+            See `ScanStats` for more details.
+        sample (float): fraction of sub-directories to visit beyond
+            `max_depth`; if smaller than 1, the sizes are estimated and shown
+            with their confidence intervals.
+            See `disk_usage()` for more details.
+        deadline (float|None): max duration of the scan of each target in
+            seconds. If reached, the results are partial (and marked so).
+        watch (float|None): min time between updates in seconds.
+            If specified, the first target is watched for changes and the
+            summary is shown again whenever it changes (until interrupted).
+            See `UsageWatch` for more details.
+        max_fds (int): max number of directories kept open during the scan.
+            If positive, entries are stat'ed relative to their directory.
+            See `walk2()` for more details.
+        exclude (Iterable[str]): glob patterns of the names to exclude
+        include (Iterable[str]): glob patterns of the file names to include
+        exclude_regex (Iterable[str]): regular expressions of the names to
+            exclude
+        include_regex (Iterable[str]): regular expressions of the file names
+            to include.
+            See `NameFilter` for more details.
+        browse (bool): browse interactively the first target, instead of
+            showing the summary. See `UsageBrowser` for more details.
+        group_by (Iterable[str]): the names of the aggregations to show
+            after the summary of each target, computed during the same scan.
+            See `AGGREGATORS` for the available names.
+        shard (tuple[int]|None): the index of the shard and the number of
+            shards. If specified, only the shard of the first target is
+            scanned and the partial results are written to stdout as JSON
+            (see `write_usage()`), to be combined with `hdu_merge()`.
+        num_shards (int): number of shards of each target.
+            If larger than 1, each target is split into shards scanned by
+            separate processes and then merged (like `shard` and
+            `hdu_merge()` would do on separate machines); only the options
+            of the scan, the rendering and `top` are used.
+        throttle (float): max number of metadata operations (listing and
+            stat calls) per second of the scan of each target (0 for
+            unlimited). If `num_shards` is larger than 1, the limit is
+            split among the shards.
+        adaptive (bool): reduce the rate of the metadata operations when
+            their latency rises. See `ScanThrottle` for more details.
+        idle_io (bool): set the I/O priority of the process to idle.
+            See `set_idle_io_priority()` for more details.
 
     Returns:
         None
     """
-    for i, base in enumerate(base_paths):
-        # deal with unicode input
-        try:
-            base = base.encode('utf-8')
-        except UnicodeDecodeError:
-            pass
-        finally:
-            base = base.decode('utf-8')
-
+    patterns = (
+        tuple(exclude), tuple(include), tuple(exclude_regex),
+        tuple(include_regex))
+    if idle_io and not set_idle_io_priority() \
+            and verbose >= VERB_LVL['low']:
+        print('W: cannot set the I/O priority to idle')
+    shard_args = (
+        follow_links, follow_mounts, allow_special, allow_hidden, only_dir,
+        max_depth, verbose, workers, dedup_links, allocated, max_fds,
+        patterns, (throttle / max(num_shards, 1), adaptive))
+    if shard is not None:
+        base = base_paths[0]
         if os.path.isdir(base):
-            contents, total, num_files, num_dirs = disk_usage(
-                base, follow_links, follow_mounts, allow_special, allow_hidden,
-                only_dir, max_depth, verbose)
-            line_sep = '\0' if eof_line_sep else '\n'
-            text = disk_usage_to_str(
-                contents, total, num_files, num_dirs, base, sort_by, units,
-                percent_precision, bar_size, line_sep, verbose)
-            if i > 0:
-                print()
-            print(text)
-        elif os.path.isfile(base):
-            size = os.path.getsize(base)
-            contents = {base: size}
-            line_sep = '\0' if eof_line_sep else '\n'
-            text = disk_usage_to_str(
-                contents, size, 1, 0, base, sort_by, units,
-                percent_precision, bar_size, line_sep, verbose)
-            print(text)
+            write_usage(
+                sys.stdout, base, _shard_usage(base, shard, *shard_args),
+                shard)
+            sys.stdout.write('\n')
+        elif verbose >= VERB_LVL['low']:
+            print('W: directory not found: {}'.format(base))
+        return
+    if browse:
+        _hdu_browse(
+            base_paths[0], follow_links, follow_mounts, allow_special,
+            allow_hidden, sort_by, units, percent_precision, bar_size,
+            verbose, workers, dedup_links, allocated, progress, max_fds,
+            patterns)
+        return
+    if watch is not None:
+        _hdu_watch(
+            base_paths[0], follow_links, follow_mounts, allow_special,
+            allow_hidden, only_dir, max_depth, sort_by, units,
+            percent_precision, bar_size, eof_line_sep, verbose, allocated,
+            watch, patterns)
+        return
+    target_args = (
+        follow_links, follow_mounts, allow_special, allow_hidden,
+        only_dir, max_depth, sort_by, units, percent_precision, bar_size,
+        eof_line_sep, verbose, workers, cache_path, cache_clear, cache_max,
+        dedup_links, allocated, progress, stream, top, export_path,
+        from_snapshot, diff_path, show_stats, sample, deadline, max_fds,
+        patterns, tuple(group_by), (throttle, adaptive))
+    if num_shards > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(num_shards)
+        results = (
+            _hdu_sharded(
+                base, executor, num_shards, shard_args, sort_by, units,
+                percent_precision, bar_size, verbose, top)
+            if os.path.isdir(base) else _hdu_target(base, *target_args)
+            for base in base_paths)
+    elif target_jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(target_jobs)
+        futures = [
+            executor.submit(_hdu_target_list, base, *target_args)
+            for base in base_paths]
+        if unordered:
+            futures = concurrent.futures.as_completed(futures)
+        results = (future.result() for future in futures)
+    else:
+        executor = None
+        # sharing the scans must not change the output
+        is_shared = len(base_paths) > 1 and not (
+            cache_path or dedup_links or progress or stream or export_path
+            or from_snapshot or diff_path or show_stats or sample < 1.0
+            or deadline is not None or verbose >= VERB_LVL['debug']
+            or group_by
+            or (any(patterns) or throttle > 0)
+            and verbose >= VERB_LVL['medium'])
+        if is_shared:
+            results = _hdu_shared_targets(
+                base_paths, target_args, max_depth, top, workers)
         else:
-            if verbose >= VERB_LVL['low']:
-                print('W: file not found: {}'.format(base))
+            results = (
+                _hdu_target(base, *target_args) for base in base_paths)
+    line_sep = '\0' if eof_line_sep else '\n'
+    try:
+        for i, (lines, is_dir) in enumerate(results):
+            if lines is not None:
+                if i > 0 and is_dir:
+                    sys.stdout.write('\n')
+                write_lines(sys.stdout, lines, line_sep)
+                sys.stdout.write('\n')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+# ======================================================================
+def hdu_merge(
+        filepaths,
+        sort_by,
+        units,
+        percent_precision,
+        bar_size,
+        eof_line_sep,
+        verbose,
+        top=0):
+    """
+    Display the human-friendly summary of disk usage from partial results.
+
+    The partial results (e.g. of the shards of a target, possibly scanned
+    on different machines) are grouped by their target and merged.
+
+    Args:
+        filepaths (list[str]): the partial results, as written by
+            `write_usage()` (e.g. with `hdu(shard=...)`)
+        sort_by (str): specify how to sort the results.
+            See `disk_usage_to_str()` for more details.
+        units (str): units of the sizes. See `humanize()`.
+        percent_precision (int): the number of decimal places of percentages
+        bar_size (int): the size of the usage bar in characters
+        eof_line_sep (bool): use the NUL char as line separator
+        verbose (int): set the level of verbosity
+        top (int): only show the largest items up to this number (0 for all)
+
+    Returns:
+        None
+    """
+    groups = {}
+    for filepath in filepaths:
+        base, shard, result = read_usage(filepath)
+        groups.setdefault(base, []).append((shard, result))
+    line_sep = '\0' if eof_line_sep else '\n'
+    for i, (base, parts) in enumerate(groups.items()):
+        contents, total, num_files, num_dirs = merge_usage(
+            result for shard, result in parts)
+        if top > 0:
+            contents = dict(heapq.nlargest(
+                top, contents.items(), key=lambda x: x[1]))
+        lines = list(_disk_usage_lines(
+            contents, total, num_files, num_dirs, base, sort_by, units,
+            percent_precision, bar_size, verbose))
+        shards = [shard for shard, result in parts if shard is not None]
+        if shards and verbose >= VERB_LVL['low']:
+            num_shards = max(shard[1] for shard in shards)
+            indexes = [shard[0] for shard in shards]
+            missing = sorted(set(range(num_shards)) - set(indexes))
+            if any(shard[1] != num_shards for shard in shards):
+                lines.append('W: inconsistent number of shards')
+            elif missing:
+                lines.append('W: missing shard(s): {} of {}'.format(
+                    ', '.join(str(index) for index in missing), num_shards))
+            if len(set(indexes)) < len(indexes):
+                lines.append('W: duplicate shard(s)')
+        if i > 0:
+            sys.stdout.write('\n')
+        write_lines(sys.stdout, lines, line_sep)
+        sys.stdout.write('\n')
 
 
 # ======================================================================
@@ -521,6 +4862,164 @@ def handle_arg():
         '-0', '--eof_line_sep',
         action='store_true',
         help='use \0 instead of \n as line separator [%(default)s]')
+    arg_parser.add_argument(
+        '-j', '--jobs', metavar='N',
+        type=int, default=1,
+        help='number of threads for scanning directories [%(default)s]')
+    arg_parser.add_argument(
+        '-J', '--target_jobs', metavar='N',
+        type=int, default=1,
+        help='max number of targets scanned concurrently [%(default)s]')
+    arg_parser.add_argument(
+        '--unordered',
+        action='store_true',
+        help='display each target as soon as it is ready [%(default)s]')
+    arg_parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='reuse the unchanged directories beyond the max depth '
+             'from a scan cache [%(default)s]')
+    arg_parser.add_argument(
+        '--cache_file', metavar='FILE',
+        default=D_CACHE_FILEPATH,
+        help='path to the scan cache file [%(default)s]')
+    arg_parser.add_argument(
+        '--cache_clear',
+        action='store_true',
+        help='remove the previous contents of the scan cache [%(default)s]')
+    arg_parser.add_argument(
+        '--cache_max', metavar='N',
+        type=int, default=-1,
+        help='max number of directories in the scan cache '
+             '(negative for unlimited) [%(default)s]')
+    arg_parser.add_argument(
+        '-H', '--dedup_links',
+        action='store_true',
+        help='count the size of hard-linked files only once [%(default)s]')
+    arg_parser.add_argument(
+        '-A', '--allocated',
+        action='store_true',
+        help='use the allocated size instead of the apparent size '
+             '[%(default)s]')
+    arg_parser.add_argument(
+        '--progress',
+        action='store_true',
+        help='show the progress of the scan on stderr [%(default)s]')
+    arg_parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='show each top-level item on stderr when complete '
+             '[%(default)s]')
+    arg_parser.add_argument(
+        '-t', '--top', metavar='N',
+        type=int, default=0,
+        help='only show the N largest items (0 for all) [%(default)s]')
+    arg_parser.add_argument(
+        '-x', '--export', metavar='FILE',
+        default=None,
+        help='write a snapshot of the scan (NDJSON, compressed if FILE ends '
+             'with .gz, .bz2 or .xz) [%(default)s]')
+    arg_parser.add_argument(
+        '--import', metavar='FILE',
+        action='append', dest='import_paths',
+        help='read the results from a snapshot instead of scanning TARGET '
+             '(can be repeated) [%(default)s]')
+    arg_parser.add_argument(
+        '--diff', metavar='FILE',
+        default=None,
+        help='show the size differences from a snapshot [%(default)s]')
+    arg_parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='show timings and counters of each scan on stderr '
+             '[%(default)s]')
+    arg_parser.add_argument(
+        '--sample', metavar='FRACTION',
+        type=float, default=1.0,
+        help='fraction of sub-directories to scan beyond the max depth; '
+             'if smaller than 1, sizes are estimated [%(default)s]')
+    arg_parser.add_argument(
+        '--deadline', metavar='SECONDS',
+        type=float, default=None,
+        help='stop scanning after this time and show partial results '
+             '[%(default)s]')
+    arg_parser.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help='show the summary again as it changes [%(default)s]')
+    arg_parser.add_argument(
+        '--watch_interval', metavar='SECONDS',
+        type=float, default=2.0,
+        help='min interval between updates with --watch [%(default)s]')
+    arg_parser.add_argument(
+        '--max_fds', metavar='N',
+        type=int, default=0,
+        help='max number of directories kept open, to stat entries relative '
+             'to their directory (faster for deep trees) [%(default)s]')
+    arg_parser.add_argument(
+        '--exclude', metavar='GLOB',
+        action='append', default=[],
+        help='skip the entries whose name matches (directories are not '
+             'scanned); can be repeated [%(default)s]')
+    arg_parser.add_argument(
+        '--exclude_regex', metavar='REGEX',
+        action='append', default=[],
+        help='skip the entries whose name contains a match (directories are '
+             'not scanned); can be repeated [%(default)s]')
+    arg_parser.add_argument(
+        '--exclude_from', metavar='FILE',
+        action='append', default=[],
+        help='skip the entries whose name matches any of the glob patterns '
+             'in FILE (one per line); can be repeated [%(default)s]')
+    arg_parser.add_argument(
+        '--include', metavar='GLOB',
+        action='append', default=[],
+        help='only count the files whose name matches; can be repeated '
+             '[%(default)s]')
+    arg_parser.add_argument(
+        '--include_regex', metavar='REGEX',
+        action='append', default=[],
+        help='only count the files whose name contains a match; can be '
+             'repeated [%(default)s]')
+    arg_parser.add_argument(
+        '-I', '--interactive',
+        action='store_true',
+        help='browse interactively the results [%(default)s]')
+    arg_parser.add_argument(
+        '-g', '--group_by', metavar='KIND',
+        action='append', default=[],
+        help='also show the usage grouped by KIND, one of: {}; computed '
+             'in the same scan; can be repeated [%(default)s]'.format(
+                 ', '.join(AGGREGATORS)))
+    arg_parser.add_argument(
+        '--shard', metavar='I/N',
+        default=None,
+        help='only scan the I-th of N shards of TARGET and write the partial '
+             'results as JSON; combine them with --merge [%(default)s]')
+    arg_parser.add_argument(
+        '--merge',
+        action='store_true',
+        help='show the merged partial results in TARGET, as written with '
+             '--shard [%(default)s]')
+    arg_parser.add_argument(
+        '--shards', metavar='N',
+        type=int, default=1,
+        help='split each TARGET into N shards scanned by separate processes '
+             '[%(default)s]')
+    arg_parser.add_argument(
+        '--throttle', metavar='OPS',
+        type=float, default=0.0,
+        help='max number of metadata operations (listing and stat) per '
+             'second, 0 for unlimited [%(default)s]')
+    arg_parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='with --throttle, back off when the latency of the operations '
+             'rises [%(default)s]')
+    arg_parser.add_argument(
+        '--idle_io',
+        action='store_true',
+        help='set the I/O priority to idle (Linux only) [%(default)s]')
     return arg_parser
 
 
@@ -536,13 +5035,91 @@ def main():
         print()
         print('II:', 'Parsed Arguments:', args)
 
+    if args.merge:
+        try:
+            hdu_merge(
+                args.TARGET, args.sort_by, args.units,
+                args.percent_precision, args.bar_size, args.eof_line_sep,
+                args.verbose, args.top)
+        except (OSError, ValueError, KeyError) as error:
+            arg_parser.error('--merge: invalid partial results: {}'.format(
+                error))
+        return
+    if args.import_paths:
+        args.TARGET = args.import_paths
+    if args.export and len(args.TARGET) > 1:
+        arg_parser.error('--export requires a single TARGET')
+    for filepath in args.exclude_from:
+        try:
+            args.exclude.extend(read_patterns(filepath))
+        except OSError as error:
+            arg_parser.error('--exclude_from: {}'.format(error))
+    for regex in args.exclude_regex + args.include_regex:
+        try:
+            re.compile(regex)
+        except re.error as error:
+            arg_parser.error('{}: invalid regex: {}'.format(regex, error))
+    if args.interactive and len(args.TARGET) > 1:
+        arg_parser.error('--interactive requires a single TARGET')
+    if args.watch and len(args.TARGET) > 1:
+        arg_parser.error('--watch requires a single TARGET')
+    for name in args.group_by:
+        if name not in AGGREGATORS:
+            arg_parser.error('--group_by: unknown aggregation: {} ({})'.format(
+                name, ', '.join(AGGREGATORS)))
+    if args.shard is not None:
+        match = re.match(r'^(\d+)/(\d+)$', args.shard)
+        if not match or not int(match.group(1)) < int(match.group(2)):
+            arg_parser.error('--shard must be I/N, with 0 <= I < N')
+        if len(args.TARGET) > 1:
+            arg_parser.error('--shard requires a single TARGET')
+        args.shard = int(match.group(1)), int(match.group(2))
+    for filepath in ([args.diff] if args.diff else []) \
+            + (args.import_paths or []):
+        try:
+            read_snapshot(filepath)[2].close()
+        except (OSError, ValueError, KeyError, TypeError, EOFError,
+                lzma.LZMAError) as error:
+            arg_parser.error('{}: invalid snapshot: {}'.format(
+                filepath, error))
+    if args.shard is not None or args.shards > 1:
+        # only the options of the scan and of the rendering are supported
+        unsupported = [
+            name for name, value in (
+                ('--shard with --shards', args.shard and args.shards > 1),
+                ('--export', args.export), ('--import', args.import_paths),
+                ('--diff', args.diff), ('--group_by', args.group_by),
+                ('--stats', args.stats), ('--cache', args.cache),
+                ('--sample', args.sample < 1.0),
+                ('--deadline', args.deadline is not None),
+                ('--stream', args.stream), ('--progress', args.progress),
+                ('--watch', args.watch),
+                ('--interactive', args.interactive),
+                ('--target_jobs', args.target_jobs > 1))
+            if value]
+        if unsupported:
+            arg_parser.error('--shard/--shards cannot be used with: {}'.format(
+                ', '.join(unsupported)))
+    if not 0.0 < args.sample <= 1.0:
+        arg_parser.error('--sample must be in the (0, 1] range')
+
     hdu(
         args.TARGET,
         args.follow_links, args.follow_mounts,
         args.allow_special, args.allow_hidden,
         args.only_dirs, args.max_depth,
         args.sort_by, args.units, args.percent_precision, args.bar_size,
-        args.eof_line_sep, args.verbose)
+        args.eof_line_sep, args.verbose, args.jobs,
+        args.target_jobs, args.unordered,
+        args.cache_file if args.cache else None,
+        args.cache_clear, args.cache_max,
+        args.dedup_links, args.allocated, args.progress, args.stream,
+        args.top, args.export, bool(args.import_paths), args.diff,
+        args.stats, args.sample, args.deadline,
+        args.watch_interval if args.watch else None, args.max_fds,
+        args.exclude, args.include, args.exclude_regex, args.include_regex,
+        args.interactive, args.group_by, args.shard, args.shards,
+        args.throttle, args.adaptive, args.idle_io)
 
 
 # ======================================================================
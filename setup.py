@@ -120,10 +120,12 @@ setup(
         ' (GPLv3+)',
 
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
 
+    python_requires='>=3.8',
+
     keywords=('hdu', 'du', 'disk', 'usage', 'console', 'cli', 'tui'),
 
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),